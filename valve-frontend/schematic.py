@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+
+# Serves a schematic described by a json config instead of python, see utils/schematic_loader.py 
+#   python schematic.py stopflow.json
+
+import sys
+from utils.schematic_loader import * 
+from utils.log_config import setup_logging
+
+
+if __name__ == "__main__":
+    setup_logging()
+    schematic = Schematic(load_config(sys.argv[1] if len(sys.argv) > 1 else 'stopflow.json'))
+    x = schematic.layout().show(title="Valves", address="localhost", port=9891, websocket_origin="localhost:9891", interactive=True)
@@ -13,6 +13,7 @@
 
 
 from utils.valve_schematic_utils import * 
+from utils.log_config import setup_logging
 
 ########################################################
 # Valves
@@ -43,6 +44,7 @@ HCl_tubing = Tubing(label='## --> To Sample', left_tubing=['line'], upstream=v_H
 # Mode Buttons 
 
 # Create high level buttons that switch operational mode.  
+# Each mode moves all four valves in one Transaction, so the callback doesn't block the ui on the serial writes.
 
 # example event object: 
 # Event(what='value', name='clicks', obj=Button(button_type='primary', clicks=3, height=60, name='Water Mode', sizing_mode='fixed', width=120), 
@@ -60,37 +62,45 @@ def update_selected_mode(btn):
     selected_mode.button_type = 'success'
 
 
-def FeCN6_mode(event): 
-    v_water.close_valve()
-    v_hellmanex.close_valve()
-    v_HCl.close_valve()
-
-    v_FeCN6.open_valve()
-    update_selected_mode(event.obj)
-
-def water_mode(event): 
-    v_FeCN6.close_valve()
-    v_hellmanex.close_valve()
-    v_HCl.close_valve()
-
-    v_water.open_valve()
-    update_selected_mode(event.obj)
-
-def hellmanex_mode(event): 
-    v_FeCN6.close_valve()
-    v_water.close_valve()
-    v_HCl.close_valve()
-
-    v_hellmanex.open_valve()
-    update_selected_mode(event.obj)    
-
-def HCl_mode(event): 
-    v_FeCN6.close_valve()
-    v_water.close_valve()
-    v_hellmanex.close_valve()
-
-    v_HCl.open_valve()
-    update_selected_mode(event.obj)
+async def FeCN6_mode(event): 
+    async with Transaction() as t: 
+        v_water.close_valve()
+        v_hellmanex.close_valve()
+        v_HCl.close_valve()
+
+        v_FeCN6.open_valve()
+    if t.ok: 
+        update_selected_mode(event.obj)
+
+async def water_mode(event): 
+    async with Transaction() as t: 
+        v_FeCN6.close_valve()
+        v_hellmanex.close_valve()
+        v_HCl.close_valve()
+
+        v_water.open_valve()
+    if t.ok: 
+        update_selected_mode(event.obj)
+
+async def hellmanex_mode(event): 
+    async with Transaction() as t: 
+        v_FeCN6.close_valve()
+        v_water.close_valve()
+        v_HCl.close_valve()
+
+        v_hellmanex.open_valve()
+    if t.ok: 
+        update_selected_mode(event.obj)
+
+async def HCl_mode(event): 
+    async with Transaction() as t: 
+        v_FeCN6.close_valve()
+        v_water.close_valve()
+        v_hellmanex.close_valve()
+
+        v_HCl.open_valve()
+    if t.ok: 
+        update_selected_mode(event.obj)
     
 FeCN6_button = pn.widgets.Button(name='Fe(CN)6 Mode', button_type='primary', width=120, height=60)
 FeCN6_button.on_click(FeCN6_mode)
@@ -162,6 +172,7 @@ stopflow_gui = pn.Column(
 
 
 if __name__ == "__main__":
+    setup_logging()
     comms_enabled = 0 
     #x = stopflow_gui.show(title="Valves", address="192.168.0.10", port=9891, websocket_origin="192.168.0.10:9891", interactive=True)
     x = stopflow_gui.show(title="Valves", address="localhost", port=9891, websocket_origin="localhost:9891", interactive=True)
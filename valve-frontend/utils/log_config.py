@@ -0,0 +1,38 @@
+# Logging setup for the frontend, through a background queue so Panel callbacks never block on stdout.
+# Kept in step with valve-server/log_config.py (the two usually run on different machines), see there for details.
+#     VALVE_LOG_LEVELS='utils.valve_frontend_http_utils=DEBUG' python stopflow.py
+
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+def parse_levels(spec):
+    '''"utils.valve_hub=DEBUG,bokeh=WARNING" -> {'utils.valve_hub': 'DEBUG', 'bokeh': 'WARNING'}'''
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(default_level='INFO', levels=None):
+    '''Route all logging through a queue to a background writer. Call once at startup, returns the QueueListener.'''
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(default_level)
+    levels = dict(levels or {}, **parse_levels(os.environ.get('VALVE_LOG_LEVELS', '')))  # environment wins
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
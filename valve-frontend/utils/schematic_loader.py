@@ -0,0 +1,159 @@
+# Builds a schematic UI from a json config instead of hand-coded python. See stopflow.json for an example.
+#
+# config keys:
+#   "title":     heading for the page
+#   "valves":    {server valve name: {"label": "## Water Valve"}}, one Valve12_UI each
+#   "elements":  {name: {"type": "valve3_straight", "valve": "water", "port": 2, "off_port": 1, ...}}
+#                type is one of valve, valve3_diag, valve3_straight, tubing. "valve" names one of the valves
+#                (needed, with "port", for all but tubing), "upstream" and "mirror" name other elements, any other
+#                keys are passed on to the class.
+#   "modes":     {button name: {"open": [element, ...], "close": [element, ...]}}, each mode is sent as one Transaction.
+#                Only valve types can be switched, and ones that are closed need an "off_port".
+#   "sections":  [{"name": "Valves", "rows": [[item, ...], ...]}, ...]
+#                an item is a valve or element name, anything else is shown as markdown. More than one section
+#                are shown as tabs.
+#
+# Valves and elements are only built when something needs them (a section being shown, or a mode button), and
+# a section's widgets only when it's first shown, so sections in tabs nobody opens cost nothing.
+
+import json
+import logging
+from functools import partial
+
+from utils.valve_schematic_utils import *
+
+log = logging.getLogger(__name__)
+
+element_types = {
+    'valve': Valve,
+    'valve3_diag': Valve3_diag,
+    'valve3_straight': Valve3_straight,
+    'tubing': Tubing,
+}
+element_references = ('upstream', 'mirror')  # keys that name another element
+valve_types = ('valve', 'valve3_diag', 'valve3_straight')  # element types that switch a 12-way valve
+
+
+def load_config(path):
+    '''Read and check a schematic config. Raises ValueError for anything that doesn't resolve.'''
+    with open(path) as f:
+        config = json.load(f)
+    valves = config.setdefault('valves', {})
+    elements = config.setdefault('elements', {})
+    config.setdefault('modes', {})
+    config.setdefault('sections', [])
+
+    for name, element in elements.items():
+        if name in valves:
+            raise ValueError(f'element {name}: already the name of a valve')
+        if element.get('type') not in element_types:
+            raise ValueError(f'element {name}: type must be one of {list(element_types)}')
+        if 'valve' in element and element['valve'] not in valves:
+            raise ValueError(f'element {name}: unknown valve {element["valve"]}')
+        if element['type'] in valve_types and ('valve' not in element or 'port' not in element):
+            raise ValueError(f'element {name}: a {element["type"]} needs a valve and a port')
+        for key in element_references:
+            if key in element and element[key] not in elements:
+                raise ValueError(f'element {name}: unknown {key} {element[key]}')
+    for mode, switches in config['modes'].items():
+        for name in switches.get('open', []) + switches.get('close', []):
+            if name not in elements:
+                raise ValueError(f'mode {mode}: unknown element {name}')
+            if elements[name]['type'] not in valve_types:
+                raise ValueError(f'mode {mode}: {name} is a {elements[name]["type"]}, only {list(valve_types)} can be switched')
+        for name in switches.get('close', []):
+            if 'off_port' not in elements[name]:
+                raise ValueError(f'mode {mode}: {name} has no off_port to close it to')
+    return config
+
+
+class Schematic():
+    '''Object graph and layout for one schematic config, built as it's needed.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.valves = {}  # name: Valve12_UI
+        self.elements = {}  # name: Valve/Valve3_*/Tubing
+        self.sections = {}  # name: layout
+        self.building = set()
+        self.mode_buttons = {}
+        self.selected_mode = None
+
+    def valve(self, name):
+        if name not in self.valves:
+            self.valves[name] = Valve12_UI(name=name)
+        return self.valves[name]
+
+    def element(self, name):
+        if name in self.elements:
+            return self.elements[name]
+        if name in self.building:
+            raise ValueError(f'element {name} refers back to itself through {element_references}')
+        self.building.add(name)
+        try:
+            params = dict(self.config['elements'][name])
+            cls = element_types[params.pop('type')]
+            if 'valve' in params:
+                params['v12_ui'] = self.valve(params.pop('valve'))
+            for key in element_references:
+                if key in params:
+                    params[key] = self.element(params[key])
+            if cls is not Tubing:
+                params.setdefault('name', name)
+            self.elements[name] = cls(**params)
+        finally:
+            self.building.discard(name)
+        return self.elements[name]
+
+    def item(self, name):
+        '''Pane for one entry in a section row.'''
+        if name in self.config['elements']:
+            return self.element(name).pane
+        if name in self.config['valves']:
+            label = self.config['valves'][name].get('label')
+            valve = self.valve(name)
+            return pn.Column(pn.Row(pn.Spacer(sizing_mode='stretch_width'), label), valve.pane) if label else valve.pane
+        return pn.pane.Markdown(name)
+
+    def section(self, name):
+        if name not in self.sections:
+            log.debug('building section %s', name)
+            section = next(s for s in self.config['sections'] if s['name'] == name)
+            self.sections[name] = pn.Column(*[pn.Row(*[self.item(i) for i in row]) for row in section.get('rows', [])])
+        return self.sections[name]
+
+    def lazy_section(self, name):
+        '''Placeholder that builds the section the first time it's rendered.'''
+        def build():
+            return self.section(name)
+        return pn.param.ParamFunction(build, lazy=True)
+
+    async def switch_mode(self, mode, event=None):
+        switches = self.config['modes'][mode]
+        async with Transaction() as t:
+            for name in switches.get('close', []):
+                self.element(name).close_valve()
+            for name in switches.get('open', []):
+                self.element(name).open_valve()
+        if t.ok:
+            if self.selected_mode:
+                self.selected_mode.button_type = 'primary'
+            self.selected_mode = self.mode_buttons[mode]
+            self.selected_mode.button_type = 'success'
+
+    def modes(self):
+        for mode in self.config['modes']:
+            if mode not in self.mode_buttons:
+                self.mode_buttons[mode] = pn.widgets.Button(name=mode, button_type='primary', width=120, height=60)
+                self.mode_buttons[mode].on_click(partial(self.switch_mode, mode))
+        return pn.Row(pn.Spacer(sizing_mode='stretch_width'), *self.mode_buttons.values(), pn.Spacer(sizing_mode='stretch_width'))
+
+    def layout(self):
+        '''Page for the whole schematic. With several sections only the open tab gets built and rendered.'''
+        header = pn.Row(pn.Spacer(sizing_mode='stretch_width'), f"# {self.config.get('title', '')}", pn.Spacer(sizing_mode='stretch_width'))
+        names = [s['name'] for s in self.config['sections']]
+        if len(names) == 1:
+            body = self.section(names[0])
+        else:
+            body = pn.Tabs(*[(n, self.lazy_section(n)) for n in names], dynamic=True)
+        return pn.Column(header, self.modes(), body) if self.config['modes'] else pn.Column(header, body)
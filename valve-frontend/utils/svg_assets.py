@@ -0,0 +1,43 @@
+# Registry for the svgs in utils/svg/.
+#
+# Each file is read and minified once, the first time something asks for it, and the text is shared.
+# Elements get their own small pane (view) around the shared text, rather than sharing pane objects between layouts,
+# so a schematic with dozens of valves costs about the same memory as one with a few, and nothing is read at import.
+#
+#   svg_assets.get('valve')               minified svg text, eg for a button icon
+#   svg_assets.view('line_on', width=50)  new pn.pane.SVG showing it
+
+import re
+import threading
+from pathlib import Path
+
+import panel as pn
+
+svg_dir = Path(__file__).parent / 'svg'
+
+cache = {}  # name: minified svg text
+lock = threading.Lock()  # sessions can be built on different threads
+
+
+def minify(text):
+    '''Drop the xml prolog, comments and editor (inkscape) metadata, and the whitespace between tags.'''
+    text = re.sub(r'<\?xml.*?\?>', '', text, flags=re.S)
+    text = re.sub(r'<!--.*?-->', '', text, flags=re.S)
+    text = re.sub(r'<(sodipodi:namedview|metadata)\b.*?</\1>', '', text, flags=re.S)
+    text = re.sub(r'>\s+<', '><', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def get(name):
+    '''Minified text of svg/<name>.svg, loaded on first use.'''
+    if name not in cache:
+        with lock:
+            if name not in cache:
+                cache[name] = minify((svg_dir / f'{name}.svg').read_text())
+    return cache[name]
+
+
+def view(name, **params):
+    '''A new pane showing svg/<name>.svg, for one layout to own. Panes are cheap, the text is shared.'''
+    return pn.pane.SVG(get(name), **params)
+
@@ -3,8 +3,117 @@
 
 from utils.valve_frontend_http_utils import * 
 
+import json
+import weakref
+import asyncio
+import logging
+import contextvars
 import panel as pn
 import param
+from utils.valve_hub import hub
+
+log = logging.getLogger(__name__)
+
+current_transaction = contextvars.ContextVar('valve_transaction', default=None)
+
+
+class Transaction(): 
+    '''Collects the valve_position changes made inside it and sends them to the server as one batch request, 
+    instead of one blocking post per valve. Use from an async callback so the ui stays responsive: 
+
+        async def water_mode(event): 
+            async with Transaction() as t: 
+                v_FeCN6.close_valve()
+                v_water.open_valve()
+            if t.ok: ...
+
+    Widgets show the new positions straight away; once the reply arrives any valve the server couldn't move is put 
+    back where it was. A plain `with Transaction():` sends the batch in the background instead of awaiting it. 
+    Transactions opened inside another one just add to the outer one.
+    '''
+
+    def __init__(self): 
+        self.moves = {}  # Valve12_UI: position to send
+        self.before = {}  # Valve12_UI: position before the transaction, to roll back to
+        self.results = {}  # valve name: {'success': 0/1, ...} once sent
+        self.ok = None
+        self.outer = None
+        self.token = None
+        self.task = None
+
+    def add(self, valve, position): 
+        self.before.setdefault(valve, valve.last_position)
+        self.moves[valve] = position
+
+    def __enter__(self): 
+        self.outer = current_transaction.get()
+        if self.outer is None: 
+            self.token = current_transaction.set(self)
+        return self.outer or self
+
+    def __exit__(self, exc_type, exc, tb): 
+        if not self.close(exc_type): 
+            return
+        try: 
+            asyncio.get_running_loop()
+        except RuntimeError: 
+            asyncio.run(self.commit())  # no event loop (eg a script), just block
+        else: 
+            self.task = asyncio.ensure_future(self.commit())
+
+    async def __aenter__(self): 
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb): 
+        if self.close(exc_type): 
+            await self.commit()
+
+    def close(self, exc_type): 
+        '''End the outermost transaction. Returns True if its moves should be sent, an exception rolls them back.'''
+        if self.outer is not None: 
+            return False
+        current_transaction.reset(self.token)
+        if exc_type is not None: 
+            self.rollback(self.moves)
+            return False
+        return True
+
+    async def commit(self): 
+        '''Send the collected moves in one request, then bring the widgets in line with what the server did.'''
+        if not self.moves: 
+            self.ok = True
+            return self.results
+        positions = {v.name: p for v, p in self.moves.items()}
+        reply = await post_valve_positions_async(positions)
+        if reply == -1: 
+            # comms disabled, ui testing
+            self.results = {name: {'success': 1} for name in positions}
+        elif reply == 0: 
+            self.results = {name: {'success': 0, 'message': 'request failed'} for name in positions}
+        else: 
+            self.results = reply
+        failed = [v for v in self.moves if not self.results.get(v.name, {}).get('success')]
+        for v, p in self.moves.items(): 
+            if v not in failed: 
+                hub.publish(v.name, position=p)
+        if failed: 
+            log.warning('moves failed: %s', {v.name: self.results.get(v.name) for v in failed})
+        self.rollback(failed)
+        self.ok = not failed
+        return self.results
+
+    def rollback(self, valves): 
+        for v in valves: 
+            v.restore(self.before.get(v))
+
+
+async def apply_positions(positions): 
+    '''Move several valves in one non-blocking request. positions is {Valve12_UI: position}. 
+    Returns the server's per-valve results, see Transaction.'''
+    async with Transaction() as t: 
+        for valve, position in positions.items(): 
+            valve.valve_position = position
+    return t.results
 
 
 class Valve12_UI(param.Parameterized): 
@@ -16,22 +125,34 @@ class Valve12_UI(param.Parameterized):
                                    )
     name = param.String(default='A')
 
-    valves = []
+    valves = weakref.WeakSet()  # every Valve12_UI, in any session
     connection_status = param.Boolean(default=False) 
+    position_known = param.Boolean(default=False, doc="False until the first position arrives from the server, buttons are greyed out till then")
 
     def __init__(self, **params):
         #self.v12 = valve_12_way  # if running the valve_driver on the same machine can reference it here to bypass the http layer
         super().__init__(**params)
-        self.pane = None
-        self.valves.append(self) 
+        self._pane = None
+        self.buttons = {}
+        self.from_server = False  # True while showing a position pushed/read from the server, so it isn't sent back as a move
+        self.last_position = None  # last position the server confirmed, a failed Transaction rolls back to it
+        self.valves.add(self) 
+
+        # position and status come from the shared hub (see valve_hub.py), read in bulk in the background the first 
+        # time any session uses this valve, so building the ui doesn't wait on the server
+        hub.subscribe(self)
 
-        self.buttons = {i: pn.widgets.Button(name=str(i), button_type='default', icon_size='4em', width=30, height=30) for i in range(1,13)}
-        for b in self.buttons.values():
-            b.on_click(self.set_valve_position)
 
-        self.draw_ui()
-        self.get_valve_position()
-        
+    @property
+    def pane(self): 
+        '''The 12 buttons are only made the first time the pane is asked for, so valves in sections that aren't shown stay cheap.'''
+        if self._pane is None: 
+            self.buttons = {i: pn.widgets.Button(name=str(i), button_type='default', icon_size='4em', width=30, height=30) for i in range(1,13)}
+            for b in self.buttons.values():
+                b.on_click(self.set_valve_position)
+            self.draw_ui()
+            self.highlight()
+        return self._pane
 
     def draw_ui(self): 
         twelve = pn.Row(
@@ -77,7 +198,7 @@ class Valve12_UI(param.Parameterized):
             self.buttons[6],
             pn.Spacer(width=90, height=30)
         )
-        self.pane = pn.Column(twelve, one, two, three, four, five, six)
+        self._pane = pn.Column(twelve, one, two, three, four, five, six)
 
     @param.depends('valve_position', watch=True)
     def set_valve_position(self, event=None): 
@@ -99,10 +220,15 @@ class Valve12_UI(param.Parameterized):
         # function was called by param.depends
         #print('param.depends - self.valve_position: ', self.valve_position)
         self.move_valve()
+        self.highlight()
 
-        # update selected button highlight
+    @param.depends('position_known', watch=True)
+    def highlight(self): 
+        '''update selected button highlight'''
         for b in self.buttons.values(): 
-            if int(b.name) == self.valve_position: 
+            if not self.position_known: 
+                b.button_type = 'light'
+            elif int(b.name) == self.valve_position: 
                 b.button_type = 'success'
             else: 
                 b.button_type = 'default'
@@ -110,23 +236,58 @@ class Valve12_UI(param.Parameterized):
     def move_valve(self): 
         #print(f'moving valve to {self.valve_position}') 
         #self.v12.set_valve_position(self.valve_position)
+        if self.from_server: 
+            return
+        if (transaction := current_transaction.get()) is not None: 
+            transaction.add(self, self.valve_position)
+            return
         if not comms_enabled: 
             return
-        post_valve_position(self.name, self.valve_position)
+        result = post_valve_position(self.name, self.valve_position)
+        if result == 1: 
+            hub.publish(self.name, position=self.valve_position)  # show it in the other sessions too
+        elif result == 0: 
+            self.restore(self.last_position)  # the server didn't take it
 
     def get_valve_position(self): 
         if not comms_enabled: 
             return
         position = get_valve_position(self.name)
-        if position == -1: 
-            print(f'failed to get valve position for {self.name}')
-        elif position == self.valve_position: 
-            pass 
+        if position in (-1, 0): 
+            log.warning('failed to get valve position for %s', self.name)
         else: 
-            self.valve_position = position
+            hub.publish(self.name, position=position)
+
+    def update_position(self, position): 
+        '''Show a position reported by the server without sending it back out as a move.'''
+        if position in (None, False): 
+            return
+        self.last_position = int(position)
+        if position == self.valve_position: 
+            self.position_known = True
+            return
+        self.from_server = True
+        try: 
+            self.valve_position = int(position)
+        finally: 
+            self.from_server = False
+        self.position_known = True
+
+    def restore(self, position): 
+        '''Go back to showing position after a move the server didn't take, or none selected if it's None.'''
+        if position is not None: 
+            self.update_position(position)
+            return
+        self.from_server = True
+        try: 
+            self.valve_position = None
+        finally: 
+            self.from_server = False
 
     def get_status(self): 
         if not comms_enabled: 
             return
-        self.connection_status = get_status(self.name)
+        reply = get_status(self.name)
+        if reply not in (-1, 0): 
+            hub.publish(self.name, status=json.loads(reply).get('data') is True)
 
@@ -1,61 +1,225 @@
 # http utilities to send requests to control 12-way valves to valve-server.
 #
-#  allows running the low level valve control on a lightweight device (eg raspberry pi), 
+#  allows running the low level valve control on a lightweight device (eg raspberry pi),
 #   while running a heavier ui on a different machine.
 
-from requests import post 
+import json
+import time
+import asyncio
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from tornado.websocket import websocket_connect
 
 URL = 'http://localhost:8972/api'
 #URL = 'http://192.168.0.102:8972/api'
+WS_URL = URL.replace('http', 'ws', 1).rsplit('/api', 1)[0] + '/ws'
 
 # switch this off to test UI
-comms_enabled = 0 
-
-def http_post(data, response_expected=False): 
-    if not comms_enabled: 
-        return -1
-    try:
-        r = post(URL, data=data)
-        #print("posted. r: ", r)
-        #print(f'{r.text = }')
-        #print(f'{r.status_code = }')
-    except Exception as e: 
-        print('post failed')
-        print(e)
-
-    if r.status_code != 200:
-        print("Status code: ", r.status_code)
-        if r.status_code == 503:
-            print("check that proxy is not connected, run 'kamo'")  # BL15 specific
-        return 0 
-    else: 
-        # success
-        if response_expected: 
-            return r.text 
-        else: 
-            return 1 
-
-def get_status(valve=None):
-    if valve is None: 
-        status = http_post({'id': 'get_status_all'}, response_expected=True)
-    else: 
-        status = http_post({'id': 'get_status', 'valve': valve}, response_expected=True)
-    return status 
-
-
-def post_valve_position(valve, position):
-    http_post({
-        'id': 'set_valve_position', 
-        'valve': valve,
-        'position': position
-    })
-
-
-def get_valve_position(valve): 
-    data = {
-        'id': 'get_valve_position', 
-        'valve': valve,
-    }
-    position = http_post(data, response_expected=True)
-    print("position returned: ", position)
-    return position
+comms_enabled = 0
+
+log = logging.getLogger(__name__)
+
+
+class ValveClient():
+    '''Talks to valve-server over one pooled keep-alive session, so each call reuses a warm connection
+    instead of opening a new one.
+
+    Reads (positions, status) are idempotent and get retried with exponential backoff, or after the server's
+    Retry-After when it's rate limiting us (429), as long as that's no more than max_retry_after seconds.
+    Other 4xx replies mean the request itself is wrong, so they're never retried.
+    Moves are sent once -- a retried GO could land after a newer one.
+    '''
+
+    def __init__(self, url=URL, connect_timeout=2, read_timeout=10, read_retries=2, backoff=.2, pool_size=4, max_retry_after=5):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)  # seconds, (connect, read) as requests expects
+        self.read_retries = read_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, data, response_expected=False, retries=0):
+        '''Returns -1 if comms are disabled, 0 on failure, otherwise 1 or the reply text if response_expected.'''
+        if not comms_enabled:
+            return -1
+        wait = None  # seconds the server asked us to wait before trying again
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(wait if wait is not None else self.backoff * 2**(attempt - 1))
+            wait = None
+            try:
+                r = self.session.post(self.url, data=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                log.warning('post failed: %s', e)
+                continue
+
+            if r.status_code != 200:
+                log.warning("Status code: %s", r.status_code)
+                if r.status_code == 503:
+                    log.warning("check that proxy is not connected, run 'kamo'")  # BL15 specific
+                if r.status_code == 429:
+                    wait = self.retry_after(r)
+                    if wait is None:
+                        return 0
+                elif 400 <= r.status_code < 500:
+                    return 0  # eg 413, asked for more valves than the server will ever take at once
+                continue
+            else:
+                # success
+                if response_expected:
+                    return r.text
+                else:
+                    return 1
+        return 0
+
+    def retry_after(self, r):
+        '''Seconds to wait from a 429's Retry-After header, None if there isn't one or it's longer than we'll block for.'''
+        try:
+            wait = float(r.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+        if wait > self.max_retry_after:
+            log.warning('rate limited for %ss, not waiting', wait)
+            return None
+        return wait
+
+    def get_status(self, valve=None):
+        if valve is None:
+            return self.post({'id': 'get_status_all'}, response_expected=True, retries=self.read_retries)
+        else:
+            return self.post({'id': 'get_status', 'valve': valve}, response_expected=True, retries=self.read_retries)
+
+    def post_valve_position(self, valve, position, wait=False, timeout=None):
+        '''Returns 1 if the server accepted the move, 0 if it or the request failed (eg valve offline), -1 if comms are off.
+        wait=True blocks until the server has seen the valve arrive (or timeout seconds pass) and returns
+        {'arrived': True/False/None, 'position': ..., 'time_to_arrival': ...} instead of 1.'''
+        data = {
+            'id': 'set_valve_position',
+            'valve': valve,
+            'position': position
+        }
+        if wait:
+            data['wait'] = 1
+            if timeout is not None:
+                data['timeout'] = timeout
+        reply = self.post(data, response_expected=True)
+        if reply in (-1, 0):
+            return reply
+        reply = json.loads(reply)
+        if not reply['success']:
+            log.warning('moving %s to %s failed: %s', valve, position, reply.get('message'))
+            return 0
+        return reply['data'] if wait else 1
+
+    def get_valve_position(self, valve, max_age=None):
+        '''max_age: seconds, let the server answer from its position cache if it's at least this fresh.'''
+        data = {
+            'id': 'get_valve_position',
+            'valve': valve,
+        }
+        if max_age is not None:
+            data['max_age'] = max_age
+        reply = self.post(data, response_expected=True, retries=self.read_retries)
+        log.debug("position returned: %s", reply)
+        if reply in (-1, 0):
+            return reply
+        reply = json.loads(reply)
+        return reply['data'] if reply['success'] else -1
+
+    def post_valve_positions(self, positions, wait=False):
+        '''Move several valves in one request. positions is {valve: position}.
+        Returns {valve: {'success': 0/1, ...}} from the server, or -1/0 if the request failed.'''
+        data = {
+            'id': 'set_valve_positions',
+            'positions': json.dumps(positions),
+        }
+        if wait:
+            data['wait'] = 1
+        reply = self.post(data, response_expected=True)
+        if reply in (-1, 0):
+            return reply
+        return json.loads(reply)['data']
+
+    async def post_valve_positions_async(self, positions, wait=False):
+        '''post_valve_positions on a worker thread, for async (eg Panel) callbacks that shouldn't block the ui.'''
+        return await asyncio.get_running_loop().run_in_executor(None, self.post_valve_positions, positions, wait)
+
+    def get_valve_positions(self, valves, max_age=None):
+        '''Read several valves in one request. Returns {valve: {'success': 0/1, 'data': position}}.'''
+        data = {
+            'id': 'get_valve_positions',
+            'valves': json.dumps(list(valves)),
+        }
+        if max_age is not None:
+            data['max_age'] = max_age
+        reply = self.post(data, response_expected=True, retries=self.read_retries)
+        if reply in (-1, 0):
+            return reply
+        return json.loads(reply)['data']
+
+    def close(self):
+        self.session.close()
+
+
+class ValveEvents():
+    '''Listens to valve-server's /ws push channel on a background thread and hands each event to the
+    callbacks subscribed for that valve. Reconnects with backoff if the server goes away.
+
+    Events look like {'valve': name, 'valve_position': 3} or {'valve': name, 'serial_is_open': False}.
+    '''
+
+    def __init__(self, url=WS_URL, reconnect_delay=1, max_reconnect_delay=30):
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.subscribers = {}  # valve name: [callback(event), ...]
+        self.thread = None
+
+    def subscribe(self, valve, callback):
+        self.subscribers.setdefault(valve, []).append(callback)
+        self.start()
+
+    def start(self):
+        if self.thread is None and comms_enabled:
+            self.thread = threading.Thread(target=lambda: asyncio.run(self.listen()), name='valve-events', daemon=True)
+            self.thread.start()
+
+    async def listen(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                conn = await websocket_connect(self.url, connect_timeout=self.reconnect_delay * 5)
+                delay = self.reconnect_delay
+                while (msg := await conn.read_message()) is not None:
+                    self.dispatch(json.loads(msg))
+                log.info('valve event stream closed')
+            except Exception as e:
+                log.warning('valve event stream failed: %s', e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def dispatch(self, event):
+        for callback in self.subscribers.get(event.get('valve'), []):
+            try:
+                callback(event)
+            except Exception as e:
+                log.exception("valve event callback failed")
+
+
+# shared client and event stream used by the ui elements
+client = ValveClient()
+valve_events = ValveEvents()
+
+# module level shortcuts, kept so existing schematics and notebooks don't need to change
+http_post = client.post
+get_status = client.get_status
+post_valve_position = client.post_valve_position
+get_valve_position = client.get_valve_position
+post_valve_positions = client.post_valve_positions
+post_valve_positions_async = client.post_valve_positions_async
+get_valve_positions = client.get_valve_positions
@@ -0,0 +1,160 @@
+# One per process: the frontend's copy of every valve's position and connection status.
+#
+# Every session's Valve12_UI subscribes here instead of talking to valve-server itself, so however many browsers are
+# open the server sees one bulk read per valve (the first time it's needed) and one /ws event stream.
+# A move made from one session is published straight to all the others.
+# Updates reach a session's widgets on that session's own thread (its document's next tick), never from the hub's
+# timer or event stream threads, so they can't interleave with a click being handled.
+
+import json
+import logging
+import threading
+import weakref
+from functools import partial
+
+import panel as pn
+
+from utils import valve_frontend_http_utils as http_utils
+
+log = logging.getLogger(__name__)
+
+
+class ValveHub():
+    '''Holds the last known position/status of each valve and fans changes out to the Valve12_UI objects showing it.
+
+    Valves that haven't been read yet are batched: everything subscribed within hydrate_delay seconds of each other
+    (eg one page being built) is filled in by get_valve_positions + get_status_all on a background thread.
+    Positions are read at most read_chunk valves per request, less than the server's rate limits let one client read
+    at once (see valve-server/admission.py), so a big schematic isn't turned away as a single oversized request.
+    Reads that fail are tried again, backing off from min_retry_delay up to max_retry_delay seconds.
+    '''
+
+    def __init__(self, hydrate_delay=.05, read_chunk=40, min_retry_delay=1, max_retry_delay=30):
+        self.hydrate_delay = hydrate_delay
+        self.read_chunk = read_chunk
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = min_retry_delay
+        self.positions = {}  # valve name: position
+        self.status = {}  # valve name: connection open
+        self.subscribers = {}  # valve name: Valve12_UI objects, weak so closed sessions drop out
+        self.requested = set()  # names already read (or being read) from the server
+        self.pending = set()  # names waiting for the next bulk read
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, ui):
+        '''Start keeping ui up to date. Shows whatever is already known straight away.
+        Call from the session ui belongs to, its document is where later updates are scheduled.'''
+        ui.doc = pn.state.curdoc  # None outside a server (scripts, notebooks), updates are then applied directly
+        with self.lock:
+            first = ui.name not in self.subscribers
+            self.subscribers.setdefault(ui.name, weakref.WeakSet()).add(ui)
+            position, status = self.positions.get(ui.name), self.status.get(ui.name)
+            if ui.name not in self.requested:
+                self.requested.add(ui.name)
+                self.pending.add(ui.name)
+                self.start_timer(self.hydrate_delay)
+
+        if not http_utils.comms_enabled:
+            ui.position_known = True  # nothing to wait for when testing the ui
+            return
+        if first:
+            http_utils.valve_events.subscribe(ui.name, self.handle_event)
+        if position is not None:
+            ui.update_position(position)
+        if status is not None:
+            ui.connection_status = status
+
+    def start_timer(self, delay):
+        '''Read the pending names after delay, unless a read is already due. Call with the lock held.'''
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.hydrate_pending)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def retry(self, names):
+        with self.lock:
+            self.pending.update(names)
+            delay, self.retry_delay = self.retry_delay, min(self.retry_delay * 2, self.max_retry_delay)
+            self.start_timer(delay)
+
+    def hydrate_pending(self):
+        with self.lock:
+            names = list(self.pending)
+            self.pending.clear()
+            self.timer = None
+        self.hydrate(names)
+
+    def hydrate(self, names=None):
+        '''Read position and status for names (default every subscribed valve), positions read_chunk valves at a time.
+        Connection status comes from the status reply, a failed position read doesn't mean the valve is down.'''
+        if not http_utils.comms_enabled:
+            return
+        names = list(self.subscribers if names is None else names)
+        if not names:
+            return
+        positions = {}
+        for i in range(0, len(names), self.read_chunk):
+            chunk = names[i:i + self.read_chunk]
+            reply = http_utils.get_valve_positions(chunk)
+            if reply in (-1, 0):
+                log.warning('failed to get valve positions for %s', chunk)
+            else:
+                positions.update(reply)
+        status = http_utils.get_status()
+        status = json.loads(status).get('data') if status not in (-1, 0) else None
+        failed = []
+        for name in names:
+            result = positions.get(name, {})
+            missing = result.get('message') == 'valve name not found'  # nothing to retry, and never connected
+            if not result.get('success'):
+                if name in positions:
+                    log.warning('failed to get valve position for %s: %s', name, result.get('message'))
+                if not missing:
+                    failed.append(name)
+            if missing:
+                connected = False
+            elif status == 'all_open':
+                connected = True
+            elif isinstance(status, dict):
+                connected = status.get(name) is True
+            else:
+                connected = None
+            self.publish(name, position=result.get('data') if result.get('success') else None, status=connected)
+        if failed:
+            self.retry(failed)
+        else:
+            self.retry_delay = self.min_retry_delay
+
+    def publish(self, name, position=None, status=None):
+        '''Record a new position and/or status for a valve and show it in every session.'''
+        with self.lock:
+            if position is not None:
+                self.positions[name] = position
+            if status is not None:
+                self.status[name] = status
+            uis = list(self.subscribers.get(name, ()))
+        for ui in uis:
+            if ui.doc is None:
+                self.show(ui, position, status)
+                continue
+            try:
+                ui.doc.add_next_tick_callback(partial(self.show, ui, position, status))
+            except Exception as e:
+                log.debug('not updating %s in a closed session: %s', name, e)
+
+    def show(self, ui, position, status):
+        if position is not None:
+            ui.update_position(position)
+        if status is not None:
+            ui.connection_status = status
+
+    def handle_event(self, event):
+        '''From the valve event stream, when any client moves a valve or its connection changes.'''
+        self.publish(event.get('valve'),
+                     position=event.get('valve_position'),
+                     status=bool(event['serial_is_open']) if 'serial_is_open' in event else None)
+
+
+hub = ValveHub()
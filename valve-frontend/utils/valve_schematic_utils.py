@@ -3,28 +3,142 @@
 # Requires valve_12port_ui.  Maps through there to control the physical VICI valves.
 
 from utils.valve_12port_ui import * 
-import sys
+from utils import svg_assets
+import heapq
+import logging
+import weakref
+import itertools
 from pathlib import Path
 abspath = Path(__file__).parent
+log = logging.getLogger(__name__)
 
-output_on = pn.pane.SVG(f'{abspath}/svg/line_on.svg') 
-output_off = pn.pane.SVG(f'{abspath}/svg/line_off.svg') 
-input_on = pn.pane.SVG(f'{abspath}/svg/line_on.svg') 
-input_off = pn.pane.SVG(f'{abspath}/svg/line_off.svg') 
-line_on = pn.pane.SVG(f'{abspath}/svg/line_on.svg')
-line_off = pn.pane.SVG(f'{abspath}/svg/line_off.svg')
-voutput_on = pn.pane.SVG(f'{abspath}/svg/vline_on.svg')
-voutput_off = pn.pane.SVG(f'{abspath}/svg/vline_off.svg')
-right_down_on = pn.pane.SVG(f'{abspath}/svg/line_on_right-down.svg') 
-right_down_off = pn.pane.SVG(f'{abspath}/svg/line_off_right-down.svg') 
-right_up_on = pn.pane.SVG(f'{abspath}/svg/line_on_right-up.svg') 
-right_up_off = pn.pane.SVG(f'{abspath}/svg/line_off_right-up.svg') 
-left_up_on = pn.pane.SVG(f'{abspath}/svg/line_on_left-up.svg') 
-left_up_off = pn.pane.SVG(f'{abspath}/svg/line_off_left-up.svg') 
-diag_fwd_on = pn.pane.SVG(f'{abspath}/svg/diag_fwd_on.svg') 
-diag_fwd_off = pn.pane.SVG(f'{abspath}/svg/diag_fwd_off.svg') 
-diag_back_on = pn.pane.SVG(f'{abspath}/svg/diag_back_on.svg') 
-diag_back_off = pn.pane.SVG(f'{abspath}/svg/diag_back_off.svg') 
+# tubing name: (svg when on, svg when off), see svg_assets.py. 
+# Each element owns its own tubing panes and switches their svg in place on a state change (set_tubing), 
+# so a mode switch only sends a few small property updates instead of rebuilding layouts.
+tubing_svgs = {
+    'input': ('line_on', 'line_off'), 
+    'output': ('line_on', 'line_off'), 
+    'line': ('line_on', 'line_off'), 
+    'voutput': ('vline_on', 'vline_off'), 
+    'right_down': ('line_on_right-down', 'line_off_right-down'), 
+    'right_up': ('line_on_right-up', 'line_off_right-up'), 
+    'left_up': ('line_on_left-up', 'line_off_left-up'), 
+    'diag_fwd': ('diag_fwd_on', 'diag_fwd_off'), 
+    'diag_back': ('diag_back_on', 'diag_back_off'), 
+}
+
+
+def tubing_svg(name, on): 
+    return svg_assets.get(tubing_svgs[name][0 if on else 1])
+
+
+def tubing_pane(name, on=False): 
+    '''A new pane showing one piece of tubing, for one element to own.'''
+    return svg_assets.view(tubing_svgs[name][0 if on else 1])
+
+
+def set_tubing(pane, name, on): 
+    '''Switch a tubing pane on/off, only touching it if it actually changes.'''
+    svg = tubing_svg(name, on)
+    if pane.object != svg: 
+        pane.object = svg
+
+
+def __getattr__(name): 
+    '''The old module level tubing panes (eg line_on, diag_fwd_off), now a new pane each time they're asked for.'''
+    tubing, _, suffix = name.rpartition('_')
+    if tubing in tubing_svgs and suffix in ('on', 'off'): 
+        return tubing_pane(tubing, suffix == 'on')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class FlowGraph(): 
+    '''Directed graph of what feeds what in the schematics: each 12-way valve feeds the valves mapped onto it, 
+    and each element feeds the ones that name it as their upstream. 
+
+    A change to a Valve12_UI.valve_position runs one pass over what's downstream of it, in topological order. 
+    Each node recomputes its state from its inputs (compute()), and the pass stops going down a branch wherever 
+    nothing changed. The redraws are applied together at the end of the pass, then mirrored valves are switched 
+    in one Transaction. Mirrors are only switched for a change made in this process's ui, not for one shown from 
+    the server (hub), otherwise every open session would send the same mirror moves.
+
+    Changes from the server reach the widgets on their session's thread (see valve_hub.py), so passes never 
+    overlap; one started during a pass (a mirror moving) is queued until that pass is done.
+    '''
+
+    def __init__(self): 
+        self.downstream = weakref.WeakKeyDictionary()  # node or Valve12_UI: nodes it feeds
+        self.mirrors = weakref.WeakKeyDictionary()  # node: valves that mirror it
+        self.watched = weakref.WeakSet()  # Valve12_UIs with a watcher on valve_position
+        self.counter = itertools.count()  # tie break for the heap
+        self.running = False
+        self.queued = []  # (nodes, switch_mirrors) waiting for a pass
+
+    def add(self, node): 
+        '''Add an element, after the elements it depends on (they're passed to its constructor, so they always are).'''
+        sources = [s for s in (getattr(node, 'v12', None), getattr(node, 'upstream', None)) if s is not None]
+        node.flow_rank = 1 + max((getattr(s, 'flow_rank', 0) for s in sources), default=0)
+        for source in sources: 
+            self.downstream.setdefault(source, weakref.WeakSet()).add(node)
+        v12 = getattr(node, 'v12', None)
+        if v12 is not None and v12 not in self.watched: 
+            v12.param.watch(self.on_position, 'valve_position')
+            self.watched.add(v12)
+        if getattr(node, 'mirror', None) is not None: 
+            self.mirrors.setdefault(node.mirror, weakref.WeakSet()).add(node)
+        node.compute()
+
+    def on_position(self, event): 
+        self.propagate(self.downstream.get(event.obj, ()), switch_mirrors=not event.obj.from_server)
+
+    def propagate(self, nodes, switch_mirrors=True): 
+        '''Recompute nodes and whatever changes downstream of them.'''
+        if self.running: 
+            # a mirrored valve moving during a pass, pick it up once this one is done
+            self.queued.append((nodes, switch_mirrors))
+            return
+        self.running = True
+        try: 
+            while True: 
+                self.run_pass(nodes, switch_mirrors)
+                if not self.queued: 
+                    break
+                nodes, switch_mirrors = self.queued.pop(0)
+        finally: 
+            self.running = False
+
+    def run_pass(self, nodes, switch_mirrors=True): 
+        heap = []
+        seen = set()
+        def push(node): 
+            if id(node) not in seen: 
+                seen.add(id(node))
+                heapq.heappush(heap, (node.flow_rank, next(self.counter), node))
+        for node in nodes: 
+            push(node)
+
+        changed = []
+        while heap: 
+            _, _, node = heapq.heappop(heap)
+            if node.compute(): 
+                changed.append(node)
+                for n in self.downstream.get(node, ()): 
+                    push(n)
+
+        with pn.io.hold(): 
+            for node in changed: 
+                node.update_ui()
+
+        if not switch_mirrors: 
+            return
+        to_switch = [m for node in changed for m in self.mirrors.get(node, ()) if m.state != node.state]
+        if to_switch: 
+            with Transaction(): 
+                for m in to_switch: 
+                    m.handle_valve()
+
+
+flow = FlowGraph()
 
 
 class Valve(param.Parameterized): 
@@ -62,57 +176,53 @@ class Valve(param.Parameterized):
 
         super().__init__(**params)
 
-        self.pane = None
-        self.left_tubing_ui = pn.Row(*[getattr(sys.modules[__name__], n + '_off') for n in self.left_tubing])
-        self.right_tubing_ui = pn.Row(*[getattr(sys.modules[__name__], n + '_off') for n in self.right_tubing]) 
-        self.valve = pn.widgets.Button(icon=open(f'{abspath}/svg/valve.svg').read(), button_type='default', name='', icon_size='4em', width=75, height=75)
-        self.valve.on_click(self.handle_valve)
-
-        self.sync()
+        self._pane = None
+        flow.add(self)
+
+    @property
+    def pane(self): 
+        '''Widgets are made the first time the pane is asked for, so elements that are never shown stay cheap.'''
+        if self._pane is None: 
+            self.left_tubing_ui = pn.Row(*[tubing_pane(n) for n in self.left_tubing])
+            self.right_tubing_ui = pn.Row(*[tubing_pane(n) for n in self.right_tubing]) 
+            self.valve = pn.widgets.Button(icon=svg_assets.get('valve'), button_type='default', name='', icon_size='4em', width=75, height=75)
+            self.valve.on_click(self.handle_valve)
+            self._pane = pn.Row(self.left_tubing_ui, self.valve, self.right_tubing_ui)
+            self.update_ui()
+        return self._pane
 
     def update_ui(self): 
-        '''Redraw the UI after a valve state has changed.'''
+        '''Update the UI after a valve state has changed. Only the tubing svgs that change get sent.'''
         #print("updating ui")
-        suffix = 'on' if self.state else 'off'
-        if self.pane is None: 
-            self.pane = pn.Row()
-        else: 
-            for i,n in enumerate([self.left_tubing_ui, self.valve, self.right_tubing_ui]):
-                try: 
-                    self.pane.remove(n)
-                except Exception as E: 
-                    print(f'couldnt remove {i}') 
-                    print(E) 
-
-        self.left_tubing_ui = pn.Row(*[getattr(sys.modules[__name__], f'{n}_{suffix}') for n in self.left_tubing])
-        self.right_tubing_ui = pn.Row(*[getattr(sys.modules[__name__], f'{n}_{suffix}') for n in self.right_tubing])
-
-        # add the newly updated ui elements to the pane 
-        self.pane.insert(0, self.left_tubing_ui)
-        self.pane.insert(1, self.valve) 
-        self.pane.insert(2, self.right_tubing_ui)
-
-    @param.depends('v12.valve_position', watch=True)
-    def sync(self): 
-        '''Sync the state of this representational valve with the current position of the physical parent 12-way valve.'''
+        if self._pane is None: 
+            return
+        for names, ui in [(self.left_tubing, self.left_tubing_ui), (self.right_tubing, self.right_tubing_ui)]: 
+            for n, pane in zip(names, ui): 
+                set_tubing(pane, n, self.state)
+
+    def compute(self): 
+        '''Sync the state of this representational valve with the current position of the physical parent 12-way valve. 
+        Returns True if it changed (see FlowGraph).'''
         #print('syncing')
-        self.state = self.v12.valve_position==self.port if self.v12 else False
-        self.update_ui() 
+        state = self.v12.valve_position==self.port if self.v12 else False
+        changed = state != self.state
+        self.state = state
+        return changed
+
+    def sync(self): 
+        flow.propagate([self])
         
     def handle_valve(self, event): 
         '''Called when valve button is clicked.  Will open/close the valve by interacting with the 
-        parent 12-way valve object.'''
+        parent 12-way valve object. The flow graph updates the state and ui once the 12-way moves.'''
         # if self.state is None: 
         #     print(f'{self.name} state is None') 
         #     return 
 
-        self.state = not self.state 
-        if self.state: 
+        if not self.state: 
             self.open_valve() 
         else: 
             self.close_valve() 
-
-        self.update_ui() 
         #print(f'{self.name} valve switched') 
 
     def open_valve(self): 
@@ -160,69 +270,60 @@ class Valve3_diag(param.Parameterized):
         self.upstream = upstream
         self.upstream_state = upstream_state
         self.mirror = mirror
-        self.input = input_off
+        self.input_on = False
 
         super().__init__(**params)
 
-        self.valve = pn.widgets.Button(icon=open(f'{abspath}/svg/valve3.svg').read(), button_type='default', icon_size='4em', width=50, height=60)
-        self.valve.on_click(self.handle_valve)
-        self.pane = pn.Column()
-        self.sync()
-
-    def update_ui(self): 
-        if self.state:
-            if self.righthanded: 
-                self.output1 = diag_fwd_off
-                self.output2 = diag_back_on
-            else: 
-                self.output1 = diag_back_off
-                self.output2 = diag_fwd_on
-        elif self.state==False: 
-            if self.righthanded: 
-                self.output1 = diag_fwd_on
-                self.output2 = diag_back_off
-            else: 
-                self.output1 = diag_back_on
-                self.output2 = diag_fwd_off
-        elif self.state is None: 
-            if self.righthanded: 
-                self.output1 = diag_fwd_off
-                self.output2 = diag_back_off
-            else: 
-                self.output1 = diag_back_off
-                self.output2 = diag_fwd_off
-
-        self.pane.clear()
+        self._pane = None
+        flow.add(self)
+
+    @property
+    def pane(self): 
+        '''Widgets are made the first time the pane is asked for, so elements that are never shown stay cheap.'''
+        if self._pane is None: 
+            self.valve = pn.widgets.Button(icon=svg_assets.get('valve3'), button_type='default', icon_size='4em', width=50, height=60)
+            self.valve.on_click(self.handle_valve)
+            self.build_ui()
+            self.update_ui()
+        return self._pane
+
+    def build_ui(self): 
+        '''Lay out the valve once, update_ui only switches the tubing svgs.'''
+        self.input = tubing_pane('input')
         if self.righthanded: 
-            self.pane.extend([
-                pn.Row(pn.Spacer(width=50), pn.Spacer(width=50), self.output1),
+            self.outputs = [('diag_fwd', tubing_pane('diag_fwd')), ('diag_back', tubing_pane('diag_back'))]
+            self._pane = pn.Column(
+                pn.Row(pn.Spacer(width=50), pn.Spacer(width=50), self.outputs[0][1]),
                 pn.Row(self.input, self.valve, pn.Spacer(width=50)),
-                pn.Row(pn.Spacer(width=50), pn.Spacer(width=50), self.output2)
-            ])
-        else: 
-            self.pane.extend([
-                pn.Row(self.output1, pn.Spacer(width=50), pn.Spacer(width=50)),
-                pn.Row(pn.Spacer(width=50), self.valve, output_on),
-                pn.Row(self.output2, pn.Spacer(width=50), pn.Spacer(width=50))
-            ])
-
-    @param.depends('upstream.state', watch=True)
-    def update_input(self): 
-        if self.upstream.state == self.upstream_state: 
-            self.input = input_on
+                pn.Row(pn.Spacer(width=50), pn.Spacer(width=50), self.outputs[1][1])
+            )
         else: 
-            self.input = input_off
-        self.update_ui()
+            self.outputs = [('diag_back', tubing_pane('diag_back')), ('diag_fwd', tubing_pane('diag_fwd'))]
+            self._pane = pn.Column(
+                pn.Row(self.outputs[0][1], pn.Spacer(width=50), pn.Spacer(width=50)),
+                pn.Row(pn.Spacer(width=50), self.valve, tubing_pane('output', on=True)),
+                pn.Row(self.outputs[1][1], pn.Spacer(width=50), pn.Spacer(width=50))
+            )
 
-    @param.depends('mirror.state', watch=True)
-    def sync_mirror(self): 
-        if self.mirror.state != self.state:
-            self.handle_valve()
-    
-    @param.depends('v12.valve_position', watch=True)
-    def sync(self): 
+    def update_ui(self): 
+        # first output is on when the valve is off, second when it's on, neither if it's somewhere else
+        if self._pane is None: 
+            return
+        set_tubing(self.outputs[0][1], self.outputs[0][0], self.state==False)
+        set_tubing(self.outputs[1][1], self.outputs[1][0], self.state==True)
+        set_tubing(self.input, 'input', self.input_on)
+
+    def compute(self): 
+        '''State from the 12-way position, input from upstream. Returns True if either changed (see FlowGraph).
+        A mirror switches this valve to match it after the pass, see FlowGraph.run_pass.'''
+        before = (self.state, self.input_on)
         self.sync_state()
-        self.update_ui() 
+        if self.upstream is not None: 
+            self.input_on = self.upstream.state == self.upstream_state
+        return (self.state, self.input_on) != before
+
+    def sync(self): 
+        flow.propagate([self])
 
     def sync_state(self): 
         if self.v12: 
@@ -237,14 +338,10 @@ class Valve3_diag(param.Parameterized):
         
     def handle_valve(self, event=None): 
         self.sync_state()
-        self.state = not self.state
-
-        if self.state: 
+        if not self.state: 
             self.open_valve() 
         else: 
             self.close_valve() 
-
-        self.update_ui() 
         #print(f'{self.name} valve switched') 
 
     def open_valve(self): 
@@ -273,32 +370,32 @@ class Valve3_straight(Valve3_diag):
         self.orientation = orientation 
         super().__init__(**params)
 
+    def compute(self): 
+        if self.upstream is None: 
+            self.input_on = True  # nothing feeding it, draw the input as wetted
+        return super().compute()
+
+    def build_ui(self): 
+        self.input = tubing_pane('input')
+        self.outputs = [('output', tubing_pane('output')), ('voutput', tubing_pane('voutput'))]
+        self._pane = pn.Column()
+        if self.orientation != 'rightdown' or not self.righthanded: 
+            log.warning("not supported yet") 
+            return
+
+        self._pane.extend([
+            pn.Row(pn.Spacer(width=50), pn.Spacer(width=50), pn.Spacer(width=50)),
+            pn.Row(self.input, self.valve, self.outputs[0][1]),
+            pn.Row(pn.Spacer(width=50), self.outputs[1][1], pn.Spacer(width=50))
+        ])
+
     def update_ui(self): 
-        if self.upstream is None:
-            self.input = input_on
-
-        if self.orientation == 'rightdown': 
-            if self.state:
-                self.output1 = output_on
-                self.output2 = voutput_off
-            elif self.state==False: 
-                self.output1 = output_off
-                self.output2 = voutput_on
-            else: 
-                self.output1 = output_off
-                self.output2 = voutput_off
-        else: 
-            print("not supported yet") 
-        
-        self.pane.clear()
-        if self.righthanded: 
-            self.pane.extend([
-                pn.Row(pn.Spacer(width=50), pn.Spacer(width=50), pn.Spacer(width=50)),
-                pn.Row(self.input, self.valve, self.output1),
-                pn.Row(pn.Spacer(width=50), self.output2, pn.Spacer(width=50))
-            ])
-        else: 
-            print("not supported yet")
+        # straight through output is on when the valve is on, the down output when it's off
+        if self._pane is None: 
+            return
+        set_tubing(self.outputs[0][1], 'output', self.state==True)
+        set_tubing(self.outputs[1][1], 'voutput', self.state==False)
+        set_tubing(self.input, 'input', self.input_on)
 
 
 class Tubing(param.Parameterized): 
@@ -321,22 +418,31 @@ class Tubing(param.Parameterized):
         self.upstream_state = upstream_state 
         
         super().__init__(**params)
-        self.pane = pn.Row() 
-        self.update_ui()
+        self._pane = None
+        flow.add(self)
+
+    @property
+    def pane(self): 
+        '''Made the first time it's asked for, like the valves.'''
+        if self._pane is None: 
+            self.left_tubing_ui = [tubing_pane(t) for t in self.left_tubing]
+            self.right_tubing_ui = [tubing_pane(t) for t in self.right_tubing]
+            if self.label: 
+                self._pane = pn.Row(*self.left_tubing_ui, self.label, *self.right_tubing_ui) 
+            else: 
+                self._pane = pn.Row(*self.left_tubing_ui, *self.right_tubing_ui) 
+            self.update_ui()
+        return self._pane
         
-    @param.depends('upstream.state', watch=True)
-    def update_ui(self, state=None):
-        if self.upstream is not None: 
-            self.state = self.upstream.state==self.upstream_state
-        else: 
-            self.state = self.state or False
+    def compute(self): 
+        state = self.upstream.state==self.upstream_state if self.upstream is not None else (self.state or False)
+        changed = state != self.state
+        self.state = state
+        return changed
 
-        self.pane.clear()
-        suffix = '_on' if self.state else '_off'
-        self.left_tubing_active = [getattr(sys.modules[__name__], t + suffix) for t in self.left_tubing]
-        self.right_tubing_active = [getattr(sys.modules[__name__], t + suffix) for t in self.right_tubing]
-
-        if self.label: 
-            self.pane.extend(self.left_tubing_active + [self.label] + self.right_tubing_active)
-        else: 
-            self.pane.extend(self.left_tubing_active + self.right_tubing_active)
+    def update_ui(self, state=None):
+        if self._pane is None: 
+            return
+        for names, panes in [(self.left_tubing, self.left_tubing_ui), (self.right_tubing, self.right_tubing_ui)]: 
+            for t, pane in zip(names, panes): 
+                set_tubing(pane, t, self.state)
@@ -0,0 +1,178 @@
+# Admission control for the api: token buckets per valve and per client, checked before anything is queued
+# for the serial workers, so one runaway script or stuck ui loop can't fill a bus and slow every other client down.
+#
+# Every valve command costs one token from that valve's bucket (one per valve for the batch commands) and one
+# per valve from the client's bucket (client is the 'client' argument if given, else the remote ip). Only valves
+# that exist get a bucket, names that don't are still charged to the client.
+# A batch bigger than a bucket could ever hold is turned away as too large rather than told to retry.
+# When a bucket runs low it sheds by priority: reads are turned away once it is below `reserve` of its burst,
+# so moves can still get through while something is polling hard.
+# Rejected requests get a 429 straight away, they never wait.
+#
+# Limits are rate/burst (tokens per second / bucket size) and can be set from VALVE_RATE_LIMITS, eg:
+#     VALVE_RATE_LIMITS='valve=10/20,client=40/80,reserve=.25' venv/bin/python server.py
+
+import os
+import time
+import logging
+
+import metrics
+
+log = logging.getLogger('admission')
+
+MOVE = 0
+READ = 1
+
+default_limits = {
+    'valve': (10, 20),  # per valve, about what one VICI on a serial line can keep up with
+    'client': (40, 80),  # per client, across all valves
+}
+default_reserve = .25  # fraction of each bucket only moves can use
+rate_window = 5  # seconds, time constant of the admitted/rejected rates
+idle_time = 600  # seconds before a quiet client's or valve's bucket is forgotten
+
+rejected = metrics.Counter('valve_admission_rejected_total', 'API requests turned away by rate limiting', ['scope', 'command'])
+admitted_rate = metrics.Gauge('valve_admission_rate', 'Admitted requests per second (smoothed)', ['scope', 'name'])
+tokens_left = metrics.Gauge('valve_admission_tokens', 'Tokens left in the bucket', ['scope', 'name'])
+
+
+def parse_limits(spec):
+    '''"valve=10/20,client=40/80,reserve=.25" -> ({'valve': (10.0, 20.0), 'client': (40.0, 80.0)}, .25)'''
+    limits, reserve = {}, None
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, value = (s.strip() for s in item.split('=', 1))
+        if name == 'reserve':
+            reserve = float(value)
+        elif name in default_limits:
+            rate, _, burst = value.partition('/')
+            limits[name] = (float(rate), float(burst or rate))
+        else:
+            raise ValueError(f'unknown rate limit {name}, expected one of {list(default_limits)} or reserve')
+    return limits, reserve
+
+
+class TokenBucket():
+    '''rate tokens per second, up to burst. Also keeps smoothed rates of what it let through and turned away.'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.used = self.updated  # last time a request was charged to it
+        self.admitted_rate = 0
+        self.rejected_rate = 0
+        self.rejected = 0
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        decay = max(0, 1 - elapsed / rate_window)
+        self.admitted_rate *= decay
+        self.rejected_rate *= decay
+
+    def available(self, cost, floor=0):
+        '''True if cost tokens can be taken without going below floor. Doesn't take them.'''
+        return self.tokens - cost >= floor
+
+    def take(self, cost):
+        self.tokens -= cost
+        self.admitted_rate += cost / rate_window
+
+    def reject(self, cost):
+        self.rejected += cost
+        self.rejected_rate += cost / rate_window
+
+    def retry_after(self, cost, floor=0):
+        '''Seconds until cost tokens would be available.'''
+        return max(0, (cost + floor - self.tokens) / self.rate) if self.rate > 0 else None
+
+    def stats(self):
+        return {'rate': self.rate, 'burst': self.burst, 'tokens': round(self.tokens, 2),
+                'admitted_per_s': round(self.admitted_rate, 2), 'rejected_per_s': round(self.rejected_rate, 2),
+                'rejected': self.rejected}
+
+
+class Admission():
+    '''See module notes. admit() is called from the IOLoop only, so there's no locking.'''
+
+    def __init__(self, limits=None, reserve=default_reserve):
+        self.limits = dict(default_limits, **(limits or {}))
+        self.reserve = reserve
+        self.valves = {}  # valve name: TokenBucket
+        self.clients = {}  # client: TokenBucket
+        self.last_pruned = time.monotonic()
+
+    def bucket(self, buckets, scope, name, now):
+        if name not in buckets:
+            buckets[name] = TokenBucket(*self.limits[scope])
+        bucket = buckets[name]
+        bucket.refill(now)
+        bucket.used = now
+        return bucket
+
+    def admit(self, client, valves, priority, command='', cost=None):
+        '''Charge one token per valve to each valve and cost (default one per valve) to the client. valves should only
+        be ones that exist. Returns None if admitted, otherwise {'scope': 'valve' or 'client', 'name': ...,
+        'retry_after': seconds}, with 'too_large': True (and no retry_after) if it never could be. All or nothing.'''
+        now = time.monotonic()
+        self.prune(now)
+        costs = {}
+        for valve in valves:
+            costs[valve] = costs.get(valve, 0) + 1
+        checks = [('client', client, self.bucket(self.clients, 'client', client, now), len(valves) if cost is None else cost)]
+        checks += [('valve', valve, self.bucket(self.valves, 'valve', valve, now), n) for valve, n in costs.items()]
+
+        for scope, name, bucket, cost in checks:
+            floor = bucket.burst * self.reserve if priority == READ else 0
+            if cost > bucket.burst - floor:
+                bucket.reject(cost)
+                rejected.inc(scope=scope, command=command)
+                log.debug('rejected %s from %s: costs %s, more than %s %s can ever admit', command, client, cost, scope, name)
+                return {'scope': scope, 'name': name, 'retry_after': None, 'too_large': True, 'cost': cost,
+                        'max_cost': bucket.burst - floor}
+            if not bucket.available(cost, floor):
+                bucket.reject(cost)
+                rejected.inc(scope=scope, command=command)
+                log.debug('rejected %s from %s: %s %s over its limit', command, client, scope, name)
+                return {'scope': scope, 'name': name, 'retry_after': bucket.retry_after(cost, floor)}
+        for _, _, bucket, cost in checks:
+            bucket.take(cost)
+        return None
+
+    def prune(self, now):
+        '''Forget clients and valves that have been quiet long enough for their bucket to be full again, and their metrics.'''
+        if now - self.last_pruned < idle_time:
+            return
+        self.last_pruned = now
+        for scope, buckets in (('valve', self.valves), ('client', self.clients)):
+            for name in [n for n, b in buckets.items() if now - b.used > idle_time]:
+                del buckets[name]
+                admitted_rate.remove(scope=scope, name=name)
+                tokens_left.remove(scope=scope, name=name)
+
+    def stats(self):
+        now = time.monotonic()
+        for buckets in (self.valves, self.clients):
+            for bucket in buckets.values():
+                bucket.refill(now)
+        return {'limits': self.limits, 'reserve': self.reserve,
+                'valves': {n: b.stats() for n, b in self.valves.items()},
+                'clients': {n: b.stats() for n, b in self.clients.items()}}
+
+    def update_metrics(self):
+        now = time.monotonic()
+        for scope, buckets in (('valve', self.valves), ('client', self.clients)):
+            for name, bucket in buckets.items():
+                bucket.refill(now)
+                admitted_rate.set(round(bucket.admitted_rate, 3), scope=scope, name=name)
+                tokens_left.set(round(bucket.tokens, 2), scope=scope, name=name)
+
+
+def from_environment():
+    '''Admission with limits from VALVE_RATE_LIMITS (see module notes) over the defaults.'''
+    limits, reserve = parse_limits(os.environ.get('VALVE_RATE_LIMITS', ''))
+    return Admission(limits, default_reserve if reserve is None else reserve)
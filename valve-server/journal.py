@@ -0,0 +1,236 @@
+# Append-only journal of valve events (moves commanded and confirmed, CP reads, reconnects, errors), with wall clock
+# timestamps so it can be lined up with beamline data.
+#
+# record() only appends to memory: the last `capacity` events stay in a ring buffer for quick queries, and a background
+# writer appends new ones to a json-lines file in batches, so serial workers and requests never wait on the disk.
+# query() pages through a time range with a cursor, reading the file a line at a time, so big ranges never get loaded
+# into memory at once. A page also stops after max_scan events from the file, matching or not, so a sparse filter over
+# a long range comes back as several quick pages rather than one full-file scan.
+#
+#   journal.setup('vici_journal.jsonl')
+#   journal.record('go', 'v1', position=3, previous=1)
+#   journal.query(valve='v1', start=time.time() - 3600, limit=100) -> {'events': [...], 'next': cursor or None}
+#
+# Each line is {"seq": 12, "t": 1700000000.123, "valve": "v1", "event": "go", ...event data}. seq carries on across restarts.
+
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import threading
+import collections
+
+log = logging.getLogger('journal')
+
+line_start = re.compile(rb'\{"seq": (\d+), "t": ([-+.\deE]+)')  # how json.dumps writes the start of each line
+
+
+class Journal():
+    '''See module notes. index_every: keep a file offset for every this many events, so queries can seek near their start.'''
+
+    def __init__(self, path='vici_journal.jsonl', capacity=10000, flush_interval=1, batch_size=500, index_every=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.index_every = index_every
+        self.recent = collections.deque(maxlen=capacity)  # ring buffer of the newest events
+        self.pending = []  # recorded but not written yet
+        self.index = None  # (seq, t, byte offset of that event's line), sparse. None until the startup scan is done
+        self.new_index = []  # entries for lines written while the startup scan runs
+        self.seq = 0
+        self.written_seq = 0  # everything up to here is in the file
+        self.dropped = 0
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        '''Only the end of an existing file is read here, for the last seq. The seek index is built by a background 
+        scan, queries until it's done just read the file from the start.'''
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.seq = self.written_seq = self.last_seq() if size else 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='journal-writer', daemon=True)
+        self.thread.start()
+        if size:
+            threading.Thread(target=self.load_index, args=(size,), name='journal-index', daemon=True).start()
+        else:
+            self.index, self.new_index = [], None
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def last_seq(self):
+        '''seq of the last complete line in the file, reading back from the end only as far as it takes.'''
+        with open(self.path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            chunk = 4096
+            while True:
+                start = max(0, end - chunk)
+                f.seek(start)
+                lines = f.read(end - start).splitlines()
+                for line in reversed(lines if start == 0 else lines[1:]):  # the first line of a chunk may be cut off
+                    try:
+                        return json.loads(line)['seq']
+                    except (ValueError, KeyError):
+                        continue
+                if start == 0:
+                    return 0
+                chunk *= 4
+
+    def load_index(self, size):
+        '''Build the seek index for the first size bytes of the file (what was there at startup), on a background thread. 
+        Only the start of each line is looked at.'''
+        index = []
+        try:
+            with open(self.path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if offset >= size:
+                        break
+                    match = line_start.match(line)
+                    if match and (offset == 0 or int(match[1]) % self.index_every == 0):
+                        index.append((int(match[1]), float(match[2]), offset))
+                    offset += len(line)
+        except OSError as e:
+            log.error('failed to index journal: %s', e)
+        with self.lock:
+            self.index, self.new_index = index + self.new_index, None
+
+    def record(self, event, valve=None, **data):
+        '''Add an event. Cheap and never touches the disk, safe from any thread.'''
+        with self.lock:
+            self.seq += 1
+            entry = {'seq': self.seq, 't': time.time(), 'valve': valve, 'event': event, **data}
+            self.recent.append(entry)
+            if self.running:
+                if len(self.pending) >= self.batch_size * 100:
+                    self.dropped += 1  # disk isn't keeping up, keep memory bounded
+                else:
+                    self.pending.append(entry)
+                    if len(self.pending) >= self.batch_size:
+                        self.lock.notify()
+        return entry
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.running and len(self.pending) < self.batch_size:
+                    self.lock.wait(self.flush_interval)
+                batch, self.pending = self.pending, []
+                running = self.running
+            if batch:
+                try:
+                    self.write(batch)
+                except OSError as e:
+                    log.error('failed to write %d journal events: %s', len(batch), e)
+            if not running:
+                return
+
+    def write(self, batch):
+        with open(self.path, 'ab') as f:
+            offset = f.tell()
+            lines = []
+            index = []
+            for event in batch:
+                line = (json.dumps(event) + '\n').encode()
+                if offset == 0 or event['seq'] % self.index_every == 0:
+                    index.append((event['seq'], event['t'], offset))
+                offset += len(line)
+                lines.append(line)
+            f.write(b''.join(lines))
+        with self.lock:
+            (self.new_index if self.index is None else self.index).extend(index)
+            self.written_seq = batch[-1]['seq']
+
+    def matches(self, event, valve, start, end, kinds):
+        return ((valve is None or event['valve'] == valve) and
+                (start is None or event['t'] >= start) and
+                (end is None or event['t'] < end) and
+                (kinds is None or event['event'] in kinds))
+
+    def query(self, valve=None, start=None, end=None, after=None, kinds=None, limit=500, max_scan=100000):
+        '''Events in [start, end) (unix seconds) for one valve (default all), oldest first, at most limit of them.
+        kinds: only these event types. Pass the returned 'next' back as after= to get the next page, which may come
+        back short (even empty) if max_scan events were read from the file without filling it.
+        Reads the file, so call it off the IOLoop.'''
+        with self.lock:
+            recent = list(self.recent)
+            written_seq = self.written_seq
+            index = list(self.index) if self.index is not None else [(0, 0, 0)]  # still indexing, read from the start
+        after = after or 0
+        events = []
+
+        # the ring buffer has everything from its oldest entry on, use the file only for anything older
+        oldest = recent[0] if recent else None
+        if oldest is None or (after + 1 < oldest['seq'] and (start is None or start < oldest['t'])):
+            for scanned, event in enumerate(self.read_file(index, after, start, written_seq), 1):
+                if end is not None and event['t'] >= end:
+                    break
+                if self.matches(event, valve, start, end, kinds):
+                    events.append(event)
+                    if len(events) >= limit:
+                        return {'events': events, 'next': event['seq']}
+                after = event['seq']
+                if scanned >= max_scan:
+                    return {'events': events, 'next': after}
+        for event in recent:
+            if event['seq'] <= after:
+                continue
+            if end is not None and event['t'] >= end:
+                break
+            if self.matches(event, valve, start, end, kinds):
+                events.append(event)
+                if len(events) >= limit:
+                    return {'events': events, 'next': event['seq']}
+        return {'events': events, 'next': None}
+
+    def read_file(self, index, after, start, last_seq):
+        '''Events from the file with seq > after (and t >= start), one line at a time, starting from the nearest index entry.'''
+        if not index or not os.path.exists(self.path):
+            return
+        i = max(bisect.bisect_right([seq for seq, _, _ in index], after + 1) - 1, 0)
+        if start is not None:
+            i = max(i, bisect.bisect_right([t for _, t, _ in index], start) - 1, 0)
+        with open(self.path, 'rb') as f:
+            f.seek(index[i][2])
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event['seq'] > last_seq:
+                    return
+                if event['seq'] <= after or (start is not None and event['t'] < start):
+                    continue
+                yield event
+
+    def stats(self):
+        with self.lock:
+            return {'seq': self.seq, 'written': self.written_seq, 'pending': len(self.pending), 'dropped': self.dropped,
+                    'in_memory': len(self.recent), 'indexed': self.index is not None}
+
+
+journal = Journal()  # records to memory only until setup() starts the writer
+
+
+def setup(path='vici_journal.jsonl', **kwargs):
+    '''Start journalling to path. Call once at startup, before valves are set up.'''
+    global journal
+    journal = Journal(path, **kwargs).start()
+    return journal
+
+
+def record(event, valve=None, **data):
+    return journal.record(event, valve, **data)
+
+
+def query(**kwargs):
+    return journal.query(**kwargs)
@@ -0,0 +1,41 @@
+# Logging setup for valve-server.
+#  Records go onto a queue and a background thread writes them out, so the request path and the serial
+#  workers never block on stdout/journald. Per-request and per-command messages are DEBUG, off by default.
+#
+#  Per-module levels come from VALVE_LOG_LEVELS, eg:
+#     VALVE_LOG_LEVELS='valve_driver=DEBUG,server=WARNING' venv/bin/python server.py
+
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+def parse_levels(spec):
+    '''"valve_driver=DEBUG,server=INFO" -> {'valve_driver': 'DEBUG', 'server': 'INFO'}'''
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(default_level='INFO', levels=None):
+    '''Route all logging through a queue to a background writer. Call once at startup, returns the QueueListener.'''
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(default_level)
+    levels = dict(levels or {}, **parse_levels(os.environ.get('VALVE_LOG_LEVELS', '')))  # environment wins
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,115 @@
+# Minimal counters/gauges/histograms for valve-server, rendered in the Prometheus text format at /metrics.
+#  (kept dependency free so the pi only needs pyserial + tornado)
+#
+# Usage:
+#   requests = Counter('valve_http_requests_total', 'API requests', ['command'])
+#   requests.inc(command='get_valve_position')
+#   print(render())
+
+import math
+import threading
+
+registry = []
+lock = threading.Lock()  # metrics get updated from the IOLoop and the serial worker threads
+
+latency_buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{escape(v)}"' for n, v in pairs) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # label values tuple: value
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labels)
+
+    def remove(self, **labels):
+        '''Drop a series, eg for something that no longer exists.'''
+        with lock:
+            self.values.pop(self.key(labels), None)
+
+    def samples(self):
+        '''[(name suffix, label values, extra labels, value)]'''
+        return [('', k, (), v) for k, v in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=latency_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with lock:
+            if key not in self.values:
+                self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            h = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h['counts'][i] += 1
+                    break
+            h['sum'] += value
+            h['count'] += 1
+
+    def samples(self):
+        samples = []
+        for key, h in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, h['counts']):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), h['sum']))
+            samples.append(('_count', key, (), h['count']))
+        return samples
+
+
+def render():
+    with lock:
+        return '\n'.join(m.render() for m in registry) + '\n'
@@ -0,0 +1,155 @@
+# Timed valve sequences (eg stopflow protocols) run on the server, so step timing doesn't depend on the
+# network or a browser. Upload a list of steps, then start/abort it and read back its status through /api.
+#
+# Steps are run in order. Each step can have:
+#   "t": 1.5                 seconds after the sequence started to run this step
+#   "delay": 0.5             or, seconds after the previous step finished
+#   "set": {"v1": 2}         moves to send, all at once
+#   "wait_for": ["v1"]       wait for these valves to arrive at their last commanded position (see VICI.confirm_move)
+#   "timeout": 5             seconds to allow for wait_for, default from the valve's measured travel time
+# eg  [{"t": 0, "set": {"v1": 2}}, {"t": 1.5, "set": {"v2": 1}}, {"wait_for": "v1"}, {"delay": 2, "set": {"v1": 1}}]
+#
+# Scheduling uses the monotonic clock. Every step records when it was scheduled, when it was dispatched and when its
+# GOs actually went out on the serial line, so timing error can be measured.
+
+import time
+import asyncio
+import logging
+
+from valve_driver import VICI
+
+log = logging.getLogger('sequence')
+
+spin_time = .005  # seconds before a step to stop sleeping and start checking the clock
+
+step_keys = {'t', 'delay', 'set', 'wait_for', 'timeout'}
+
+
+def parse_steps(steps):
+    '''Check an uploaded sequence and normalise it. Raises ValueError with a message for the client.'''
+    if not isinstance(steps, list) or not steps:
+        raise ValueError('sequence must be a non-empty list of steps')
+    parsed = []
+    for i, step in enumerate(steps):
+        if not isinstance(step, dict) or not step.keys() <= step_keys:
+            raise ValueError(f'step {i}: expected an object with keys from {sorted(step_keys)}')
+        if 't' in step and 'delay' in step:
+            raise ValueError(f'step {i}: use either t or delay, not both')
+        moves = step.get('set', {})
+        if not isinstance(moves, dict):
+            raise ValueError(f'step {i}: set must be {{valve: position}}')
+        wait_for = step.get('wait_for', [])
+        wait_for = [wait_for] if isinstance(wait_for, str) else list(wait_for)
+        for valve in list(moves) + wait_for:
+            if valve not in VICI.valves:
+                raise ValueError(f'step {i}: unknown valve {valve}')
+        for valve, position in moves.items():
+            if VICI.valves[valve].check_position(position) is None:
+                raise ValueError(f'step {i}: invalid position {position!r} for {valve}, expected 1 to {VICI.valves[valve].positions}')
+        parsed.append({'t': float(step['t']) if 't' in step else None,
+                       'delay': float(step.get('delay', 0)),
+                       'set': {v: int(p) for v, p in moves.items()},
+                       'wait_for': wait_for,
+                       'timeout': float(step['timeout']) if step.get('timeout') is not None else None})
+    return parsed
+
+
+class Sequence():
+    '''One uploaded sequence. start() runs it as a task on the IOLoop, status() reports progress and step timing.'''
+
+    current = None  # the last uploaded sequence, only one at a time
+
+    def __init__(self, steps, name='sequence'):
+        self.name = name
+        self.steps = parse_steps(steps)
+        self.state = 'ready'  # running, done, failed, aborted
+        self.task = None
+        self.start_time = None
+        self.records = []
+
+    def start(self):
+        if self.state == 'running':
+            raise ValueError('sequence already running')
+        self.records = []
+        self.state = 'running'
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def abort(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            return True
+        return False
+
+    def now(self):
+        return time.monotonic() - self.start_time
+
+    async def run(self):
+        self.start_time = time.monotonic()
+        log.info('starting sequence %s, %d steps', self.name, len(self.steps))
+        previous_end = 0
+        try:
+            for i, step in enumerate(self.steps):
+                scheduled = step['t'] if step['t'] is not None else previous_end + step['delay']
+                await self.sleep_until(scheduled)
+                record = {'step': i, 'scheduled': scheduled, 'dispatched': self.now()}
+                record['error'] = record['dispatched'] - scheduled
+                self.records.append(record)
+
+                ok = True
+                if step['set']:
+                    ok = await self.dispatch(step['set'], record) and ok
+                if step['wait_for']:
+                    ok = await self.wait_for(step['wait_for'], step['timeout'], record) and ok
+                record['finished'] = previous_end = self.now()
+                record['status'] = 'ok' if ok else 'failed'
+                if not ok:
+                    self.state = 'failed'
+                    log.warning('sequence %s failed at step %d: %s', self.name, i, record)
+                    return
+            self.state = 'done'
+            log.info('sequence %s done', self.name)
+        except asyncio.CancelledError:
+            self.state = 'aborted'
+            log.info('sequence %s aborted', self.name)
+        except Exception:
+            self.state = 'failed'
+            log.exception('sequence %s failed', self.name)
+
+    async def sleep_until(self, scheduled):
+        '''Sleep most of the way, then yield to the loop until it's time. asyncio's timer alone can wake a few ms late.'''
+        await asyncio.sleep(max(0, scheduled - self.now() - spin_time))
+        while self.now() < scheduled:
+            await asyncio.sleep(0)
+
+    async def dispatch(self, moves, record):
+        '''Send all of a step's moves at once and record when each GO went out on the wire.'''
+        for valve in moves:
+            v = VICI.valves[valve]
+            if v.initializing or v.is_down():
+                record['moves'] = {valve: 'offline'}
+                return False
+        results = await asyncio.gather(*[VICI.valves[v].move_async(p) for v, p in moves.items()], return_exceptions=True)
+        record['moves'] = {}
+        for (valve, position), result in zip(moves.items(), results):
+            v = VICI.valves[valve]
+            if result is True and v.commanded_position == position:
+                record['moves'][valve] = {'position': position, 'written': v.move_start - self.start_time}
+            else:
+                record['moves'][valve] = 'failed'
+        return all(isinstance(m, dict) for m in record['moves'].values())
+
+    async def wait_for(self, valves, timeout, record):
+        results = await asyncio.gather(*[VICI.valves[v].confirm_move(VICI.valves[v].commanded_position, timeout)
+                                         if VICI.valves[v].commanded_position is not None else asyncio.sleep(0, True)
+                                         for v in valves])
+        record['arrived'] = {v: r for v, r in zip(valves, results)}
+        return all(r is not False for r in results)
+
+    def status(self):
+        return {'name': self.name,
+                'state': self.state,
+                'elapsed': self.now() if self.start_time is not None and self.state == 'running' else None,
+                'steps': len(self.steps),
+                'records': self.records,
+                'max_abs_error': max((abs(r['error']) for r in self.records), default=None)}
@@ -1,76 +1,299 @@
 #!/home/pi/valve-server/venv/bin/python 
 
 # Takes http requests to communicate with vici valves via valve_driver.py
-
-from tornado import web, ioloop
-# import json
+# Serial I/O runs on a worker thread per device (VICI.run_async), so a slow or timed out valve 
+# doesn't hold up requests to the other valves.
+
+from tornado import web, ioloop, websocket
+import sys
+import json
+import signal
+import atexit
+import asyncio
+import functools
+import logging
+import metrics
+import journal
+import admission
+from log_config import setup_logging
+from sequence import Sequence
 
 from valve_driver import * 
 
+INITIALIZING = -2  # valve exists but setup hasn't finished yet
+OFFLINE = -3  # valve's circuit breaker is open, it's being reconnected in the background
+INVALID_POSITION = -4  # not a port on the valve, nothing was sent
+
+log = logging.getLogger('server')
+
+max_events_per_page = 5000
+
+limiter = admission.Admission()  # replaced with the VALVE_RATE_LIMITS settings at startup, see admission.py
+
+request_latency = metrics.Histogram('valve_http_request_seconds', 'API request latency per command', ['command'])
+queue_depth = metrics.Gauge('vici_queue_depth', 'Commands waiting on the serial bus worker', ['valve'])
+queue_coalesced = metrics.Gauge('vici_queue_coalesced', 'GOs dropped (so far) because a newer one replaced them', ['valve'])
+valve_open = metrics.Gauge('vici_serial_open', '1 if the serial connection is up', ['valve'])
+
 
 def get_status(valve):
     if valve in VICI.valves: 
-        return VICI.valves[valve].serial_is_open
+        return VICI.valves[valve].get_status()
     else: 
-        print('valve name not found!') 
+        log.warning('valve name not found: %s', valve) 
         return -1 
 
 
 def get_status_all(): 
-    if VICI.get_all_connections_open(): 
+    if VICI.get_all_connections_open() and not any(v.initializing for v in VICI.valves.values()): 
         return 'all_open'
     else: 
-        return {v.name: v.serial_is_open for v in VICI.valves.values()}
+        return {v.name: v.get_status() for v in VICI.valves.values()}
 
 
-def get_valve_position(valve): 
+async def get_valve_position(valve, max_age=None): 
+    '''max_age: seconds, answer from the driver's cache if it is at least this fresh. None always reads the valve.'''
     if valve in VICI.valves: 
-        return VICI.valves[valve].get_valve_position() 
+        if VICI.valves[valve].initializing: 
+            return INITIALIZING
+        if VICI.valves[valve].is_down(): 
+            return OFFLINE
+        return await VICI.valves[valve].read_position(max_age) 
     else: 
-        print('valve name not found!') 
+        log.warning('valve name not found: %s', valve) 
         return -1 
 
 
-def set_valve_position(valve, position): 
+async def set_valve_position(valve, position, wait=False, timeout=None): 
+    '''wait: also wait for the valve to get there (see VICI.confirm_move) and reply with 
+    {'arrived': True/False/None, 'position': where it is, 'time_to_arrival': seconds}.'''
     if valve in VICI.valves:
-        success = VICI.valves[valve].set_valve_position(position) 
+        v = VICI.valves[valve]
+        if v.initializing: 
+            return INITIALIZING
+        if v.is_down(): 
+            return OFFLINE
+        if v.check_position(position) is None: 
+            return INVALID_POSITION
+        success = await v.move_async(position) 
+        if success and wait: 
+            arrived = await v.confirm_move(position, timeout)
+            return {'arrived': arrived, 
+                    'position': v.valve_position, 
+                    'time_to_arrival': v.move_stats['last_time_to_arrival'] if arrived else None}
         if success: 
             return 1 
         else: 
             return 0 
     else: 
-        print('valve name not found!') 
+        log.warning('valve name not found: %s', valve) 
         return -1 
 
 
+def batch_result(response): 
+    '''Per-valve entry for a batch reply, same shape as a single command reply.'''
+    if isinstance(response, Exception) or response is False or response == 0: 
+        return {'success': 0, 'message': 'error'}
+    elif response == -1: 
+        return {'success': 0, 'message': 'valve name not found'}
+    elif response == INITIALIZING: 
+        return {'success': 0, 'message': 'valve initializing'}
+    elif response == OFFLINE: 
+        return {'success': 0, 'message': 'valve offline'}
+    elif response == INVALID_POSITION: 
+        return {'success': 0, 'message': 'invalid position'}
+    else: 
+        return {'success': 1, 'data': response}
+
+
+async def set_valve_positions(positions, wait=False, timeout=None): 
+    '''Move several valves at once. positions is {valve: position}. 
+    Each serial port has its own worker, so the moves go out in parallel and the batch takes about as long as the slowest valve. 
+    Daisy chained valves sharing a port have their GOs queued at move priority, so they are written back to back.'''
+    responses = await asyncio.gather(*[set_valve_position(v, p, wait, timeout) for v, p in positions.items()], return_exceptions=True)
+    return {v: batch_result(r) for v, r in zip(positions, responses)}
+
+
+def get_move_stats(): 
+    '''Per valve: confirmed moves, commanded vs actual mismatches and time to arrival, see VICI.confirm_move.'''
+    return {v.name: v.get_move_stats() for v in VICI.valves.values()}
+
+
+def get_queue_stats(): 
+    '''Per valve: commands waiting on its bus worker and GOs dropped because a newer one replaced them.'''
+    return {v.name: v.queue_stats() for v in VICI.valves.values()}
+
+
+async def get_valve_positions(valves, max_age=None): 
+    '''Read several valves at once, in parallel across devices.'''
+    responses = await asyncio.gather(*[get_valve_position(v, max_age) for v in valves], return_exceptions=True)
+    return {v: batch_result(r) for v, r in zip(valves, responses)}
+
+
+def parse_valve_list(raw): 
+    '''Accepts a json list '["v1", "v2"]' or a plain comma separated string 'v1,v2'.'''
+    try: 
+        valves = json.loads(raw)
+    except ValueError: 
+        valves = raw.split(',')
+    if isinstance(valves, str): 
+        valves = [valves]
+    return [v.strip() for v in valves if v.strip()]
+
+
+async def get_events(valve=None, start=None, end=None, after=None, kinds=None, limit=500): 
+    '''Page of journalled valve events, see journal.py. Pass the reply's 'next' back as after to get the next page.
+    The query reads the journal file, so it runs on the executor rather than holding up the IOLoop.'''
+    if limit < 1: 
+        raise ValueError('limit must be at least 1')
+    query = functools.partial(journal.query, valve=valve, start=start, end=end, after=after, kinds=kinds, 
+                              limit=min(limit, max_events_per_page))
+    return await ioloop.IOLoop.current().run_in_executor(None, query)
+
+
+def upload_sequence(steps, name='sequence'): 
+    '''Replace the current sequence (see sequence.py for the step format). Can't replace one that's running.'''
+    if Sequence.current is not None and Sequence.current.state == 'running': 
+        raise ValueError('a sequence is running, abort it first')
+    Sequence.current = Sequence(steps, name)
+    return {'name': name, 'steps': len(Sequence.current.steps)}
+
+
+def start_sequence(): 
+    if Sequence.current is None: 
+        raise ValueError('no sequence uploaded')
+    Sequence.current.start()
+    return Sequence.current.status()
+
+
+def abort_sequence(): 
+    if Sequence.current is None: 
+        raise ValueError('no sequence uploaded')
+    return int(Sequence.current.abort())
+
+
+def get_sequence_status(): 
+    '''State and per-step timing (scheduled vs dispatched, seconds from start) of the current sequence.'''
+    if Sequence.current is None: 
+        return None
+    return Sequence.current.status()
+
+
 class ApiHandler(web.RequestHandler):
     '''API handler'''
 
-    commands = ['get_status', 'get_status_all', 'get_valve_position', 'set_valve_position']
+    commands = ['get_status', 'get_status_all', 'get_valve_position', 'set_valve_position', 
+                'get_valve_positions', 'set_valve_positions', 'get_queue_stats', 'get_move_stats', 
+                'upload_sequence', 'start_sequence', 'abort_sequence', 'get_sequence_status', 'get_events', 
+                'get_admission_stats']
+
+    def get_max_age(self): 
+        '''Optional max_age argument in seconds, None if not given.'''
+        max_age = self.get_argument("max_age", None)
+        return float(max_age) if max_age not in (None, '') else None
+
+    def get_wait(self): 
+        '''Optional wait (or confirm) flag and timeout in seconds for moves. Returns (wait, timeout).'''
+        wait = self.get_argument("wait", None) or self.get_argument("confirm", None)
+        timeout = self.get_argument("timeout", None)
+        return (wait not in (None, '', '0', 'false', 'False'), 
+                float(timeout) if timeout not in (None, '') else None)
+
+    def get_float(self, name): 
+        value = self.get_argument(name, None)
+        return float(value) if value not in (None, '') else None
+
+    def get_client(self): 
+        '''Who to charge for rate limiting: the optional client argument, else the remote address.'''
+        return self.get_argument("client", None) or self.request.remote_ip
+
+    def admit(self, valves, priority): 
+        '''Check the rate limits (admission.py) for a command on valves. If it's over, replies 429 and returns False.'''
+        # only real valves get a bucket, but every name counts against the client
+        refused = limiter.admit(self.get_client(), [v for v in valves if v in VICI.valves], priority, self.command, cost=len(valves))
+        if refused is None: 
+            return True
+        if refused.get('too_large'): 
+            self.set_status(413)
+            self.finish({'success': 0, 'message': f"too many valves in one request for the {refused['scope']} {refused['name']} limit, "
+                                                  f"split it up (costs {refused['cost']}, at most {refused['max_cost']:g})", **refused})
+            return False
+        self.set_status(429)
+        if refused['retry_after'] is not None: 
+            self.set_header('Retry-After', str(max(1, round(refused['retry_after']))))
+        self.finish({'success': 0, 'message': f"rate limited: {refused['scope']} {refused['name']}", **refused})
+        return False
 
     def get(self, *args):
-        print("api get, not supported")
+        log.info("api get, not supported")
         self.finish('')
 
-    def post(self):
-        print("got post")
-        print("self.request.body: ", self.request.body)
+    def on_finish(self): 
+        request_latency.observe(self.request.request_time(), command=getattr(self, 'command', 'invalid'))
+
+    async def post(self):
+        log.debug("post body: %s", self.request.body)
         try:
             #data = json.loads(self.request.body)
             command = self.get_argument("id")
-            print(f"api post w/: command: {command}")
+            self.command = command if command in self.commands else 'invalid'
+            log.debug("api post w/ command: %s", command)
         except: 
-            print("invalid post") 
+            log.warning("invalid post") 
             return
 
         if command not in self.commands: 
-            print("invalid command")
+            log.warning("invalid command: %s", command)
             self.finish({'success': 0, 'message': 'invalid command'})
             return
 
         try: 
             if command == 'get_status_all': 
                 response = get_status_all()
+            elif command == 'get_queue_stats': 
+                response = get_queue_stats()
+            elif command == 'get_move_stats': 
+                response = get_move_stats()
+            elif command == 'get_admission_stats': 
+                response = limiter.stats()
+            elif command == 'get_events': 
+                try: 
+                    after, limit = self.get_argument("after", None), self.get_argument("limit", None)
+                    kinds = self.get_argument("kinds", None)
+                    response = await get_events(self.get_argument("valve", None) or None, self.get_float("start"), self.get_float("end"), 
+                                                int(after) if after else None, parse_valve_list(kinds) if kinds else None, 
+                                                int(limit) if limit else 500)
+                except ValueError: 
+                    self.finish({'success': 0, 'message': 'invalid start, end, after or limit argument'}); return
+            elif command in ('upload_sequence', 'start_sequence', 'abort_sequence', 'get_sequence_status'): 
+                try: 
+                    if command == 'upload_sequence': 
+                        response = upload_sequence(json.loads(self.get_argument("steps")), self.get_argument("name", "sequence"))
+                    elif command == 'start_sequence': 
+                        response = start_sequence()
+                    elif command == 'abort_sequence': 
+                        response = abort_sequence()
+                    else: 
+                        response = get_sequence_status()
+                except (ValueError, web.MissingArgumentError) as e: 
+                    self.finish({'success': 0, 'message': str(e)}); return
+            elif command == 'set_valve_positions': 
+                try: 
+                    positions = json.loads(self.get_argument("positions"))
+                    assert isinstance(positions, dict)
+                except: 
+                    self.finish({'success': 0, 'message': 'missing or invalid positions argument, expected json {valve: position}'}); return
+                if not self.admit(list(positions), admission.MOVE): 
+                    return
+                response = await set_valve_positions(positions, *self.get_wait())
+            elif command == 'get_valve_positions': 
+                try: 
+                    valves = parse_valve_list(self.get_argument("valves"))
+                except: 
+                    self.finish({'success': 0, 'message': 'missing valves argument'}); return
+                if not self.admit(valves, admission.READ): 
+                    return
+                response = await get_valve_positions(valves, self.get_max_age())
             else: 
                 try: 
                     valve = self.get_argument("valve")
@@ -80,36 +303,105 @@ class ApiHandler(web.RequestHandler):
                 if command == 'get_status': 
                     response = get_status(valve) 
                 elif command == 'get_valve_position': 
-                    response = get_valve_position(valve)
+                    if not self.admit([valve], admission.READ): 
+                        return
+                    response = await get_valve_position(valve, self.get_max_age())
                 elif command == 'set_valve_position': 
                     try: 
                         position = self.get_argument("position")
                     except: 
                         self.finish({'success': 0, 'message': 'missing position argument'}); return
-                    response = set_valve_position(valve, position)
+                    if not self.admit([valve], admission.MOVE): 
+                        return
+                    response = await set_valve_position(valve, position, *self.get_wait())
         except Exception as e: 
-            print("failed to serve request") 
+            log.exception("failed to serve request") 
             self.finish({'success': 0, 'message': 'error'}); return 
 
         if response == -1: 
             self.finish({'success': 0, 'message': 'valve name not found'}); return 
+        elif response == INITIALIZING: 
+            self.finish({'success': 0, 'message': 'valve initializing'}); return 
+        elif response == OFFLINE: 
+            self.finish({'success': 0, 'message': 'valve offline'}); return 
+        elif response == INVALID_POSITION: 
+            self.finish({'success': 0, 'message': 'invalid position'}); return 
         else: 
             self.finish({'success': 1, 'data': response}); return 
 
 
+class EventsHandler(websocket.WebSocketHandler): 
+    '''Pushes valve position and connection status changes to subscribed clients as json: 
+        {"valve": name, "valve_position": 3}  or  {"valve": name, "serial_is_open": false}
+    A snapshot of every valve is sent on connect.'''
+
+    clients = set()
+
+    def check_origin(self, origin): 
+        return True  # frontend is usually served from a different host
+
+    def open(self): 
+        EventsHandler.clients.add(self)
+        for v in VICI.valves.values(): 
+            self.write_message({'valve': v.name, 'valve_position': v.valve_position, 'serial_is_open': v.serial_is_open, 
+                                'initializing': v.initializing})
+
+    def on_close(self): 
+        EventsHandler.clients.discard(self)
+
+    def on_message(self, message): 
+        pass  # push only, commands go through /api
+
+    def broadcast(event): 
+        for client in list(EventsHandler.clients): 
+            try: 
+                client.write_message(event)
+            except websocket.WebSocketClosedError: 
+                EventsHandler.clients.discard(client)
+
+    def subscribe_to_driver(loop): 
+        '''Forward driver change notifications (made on device worker threads) onto the IOLoop.'''
+        def listener(name, field, value): 
+            loop.add_callback(EventsHandler.broadcast, {'valve': name, field: value})
+        VICI.listeners.append(listener)
+
+
+class MetricsHandler(web.RequestHandler): 
+    '''Prometheus text format, see metrics.py'''
+
+    def get(self): 
+        for v in VICI.valves.values(): 
+            stats = v.queue_stats()
+            queue_depth.set(stats['depth'], valve=v.name)
+            queue_coalesced.set(stats['coalesced'], valve=v.name)
+            valve_open.set(int(bool(v.serial_is_open)), valve=v.name)
+        limiter.update_metrics()
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.render())
+
+
 app = web.Application([
     (r'/api', ApiHandler),
+    (r'/ws', EventsHandler),
+    (r'/metrics', MetricsHandler),
 ])
 
 
 if __name__ == '__main__':
-    print("Establishing valve connections...") 
-    setup_valves()
+    setup_logging(levels={'tornado.access': 'WARNING'})  # access log is per request, set VALVE_LOG_LEVELS=tornado.access=INFO to see it
+    atexit.register(journal.setup('vici_journal.jsonl').stop)  # write out what's still pending on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # systemctl stop, exit normally so atexit runs
+    limiter = admission.from_environment()
+    EventsHandler.subscribe_to_driver(ioloop.IOLoop.current())
+
+    log.info("Establishing valve connections...") 
+    # optional config file argument, eg a vici_simulator.py config. Setup carries on in the background while we serve.
+    setup_valves(*sys.argv[1:2], wait=False)
 
     port = 8972 
-    print(f'Server is starting on port {port}')
+    log.info('Server is starting on port %s', port)
     app.listen(port)
-    ioloop.IOLoop.instance().start()
+    ioloop.IOLoop.current().start()
 
 
 #####################################################################
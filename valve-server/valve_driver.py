@@ -2,8 +2,17 @@
 #  Either configure the devices to use in VICI_config.csv, or just modify setup_valves() and enter them here directly. 
 
 import os
+import json
 import time
+import asyncio
+import threading
+import heapq
+import logging
+import itertools
+import concurrent.futures
 import serial
+import metrics
+import journal
 
 serial_id_1 = '/dev/serial/by-id/usb-FTDI_Chipi-X_FT5N6OYA-if00-port0'
 serial_id_2 = '/dev/serial/by-id/usb-Belkin_USB_PDA_Adapter_0109_320165-if00-port0'
@@ -11,22 +20,255 @@ serial_id_3 = '/dev/serial/by-id/usb-FTDI_Chipi-X_FT5N6R5N-if00-port0'
 serial_id_4 = '/dev/serial/by-id/usb-Prolific_Technology_Inc._USB-Serial_Controller_D-if00-port0'
 
 
+log = logging.getLogger('valve_driver')
+
+serial_rtt = metrics.Histogram('vici_serial_rtt_seconds', 'Serial round trip per command (write time for GO)', ['valve', 'command'])
+serial_timeouts = metrics.Counter('vici_serial_read_timeouts_total', 'Serial reads that timed out without a full reply', ['valve', 'command'])
+reconnects = metrics.Counter('vici_reconnect_attempts_total', 'open_serial_connection attempts', ['valve', 'result'])
+reply_timeouts = metrics.Gauge('vici_serial_reply_timeout_seconds', 'Current read timeout, from the smoothed round trip', ['valve'])
+
+reply_prefixes = ('CP', 'AM', 'IFM', 'ID')  # VICI replies start with the command they answer
+
+
+first_poll = .5  # confirm_move's first CP, as a fraction of the expected travel time
+
+
+def command_name(msg): 
+    '''Metric label for a command: CP, GO, AM, IFM, ID or /?, without arguments.'''
+    return 'IFM' if msg.startswith('IFM') else msg[:2]
+
+
+class Job(): 
+    '''A queued call on a SerialBus worker. Several futures can wait on one job when newer requests supersede older ones.'''
+
+    def __init__(self, func, args, priority, key, valve): 
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.key = key
+        self.valve = valve
+        self.futures = [concurrent.futures.Future()]
+
+    def run(self): 
+        futures = [f for f in self.futures if f.set_running_or_notify_cancel()]
+        if not futures: 
+            return  # everyone waiting gave up, eg a confirm_move poll that timed out
+        try: 
+            result = self.func(*self.args)
+        except BaseException as e: 
+            for f in futures: 
+                f.set_exception(e)
+        else: 
+            for f in futures: 
+                f.set_result(result)
+
+
+class SerialBus(): 
+    '''One usb-serial port, shared by every VICI daisy chained on it. 
+
+    Owns the serial.Serial and the single worker thread that all commands for the port run on, so commands from 
+    different units queue up instead of interleaving on the wire. Replies are matched to units by their id prefix.
+
+    The worker runs jobs by priority (MOVE, then READ, then BACKGROUND), oldest first within a priority. 
+    A job submitted with a key replaces a waiting job with the same key, eg a newer GO for the same valve 
+    supersedes one that hasn't been written yet. The superseded caller gets the newer job's result.
+    '''
+    buses = {}
+    MOVE, READ, BACKGROUND = 0, 1, 2  # job priorities, lower runs first
+    poll_interval = .02  # seconds, longest a single serial read blocks, so reads notice their deadline
+
+    def __init__(self, dev): 
+        self.dev = dev
+        self.serial = None
+        self.buffer = bytearray()  # received bytes not yet returned as a reply
+        self.broken = False  # set after an I/O error on the port, the next open() reopens it even if units share it
+        self.units = {}  # id_number: VICI
+        self.queue = []  # heap of (priority, seq, job)
+        self.waiting = {}  # key: job, for jobs that can still be superseded
+        self.seq = itertools.count()
+        self.queue_lock = threading.Condition()
+        self.depth = {}  # valve name: jobs waiting
+        self.coalesced = {}  # valve name: jobs dropped because a newer one replaced them
+        self.worker = threading.Thread(target=self.run_jobs, name=f'vici-{os.path.basename(dev)}', daemon=True)
+        self.worker.start()
+
+    def submit(self, func, *args, priority=None, key=None, valve=None): 
+        '''Queue func(*args) on the worker thread. Returns a concurrent.futures.Future.'''
+        priority = SerialBus.READ if priority is None else priority
+        with self.queue_lock: 
+            job = self.waiting.get(key) if key is not None else None
+            if job is not None: 
+                # supersede: run the newest call in the old job's place, everyone waiting gets its result
+                job.func, job.args = func, args
+                job.futures.append(concurrent.futures.Future())
+                self.coalesced[valve] = self.coalesced.get(valve, 0) + 1
+                if priority < job.priority: 
+                    job.priority = priority
+                    heapq.heappush(self.queue, (priority, next(self.seq), job))  # old heap entry is skipped when popped
+                return job.futures[-1]
+
+            job = Job(func, args, priority, key, valve)
+            if key is not None: 
+                self.waiting[key] = job
+            self.depth[valve] = self.depth.get(valve, 0) + 1
+            heapq.heappush(self.queue, (priority, next(self.seq), job))
+            self.queue_lock.notify()
+            return job.futures[0]
+
+    def run_jobs(self): 
+        while True: 
+            with self.queue_lock: 
+                while True: 
+                    while not self.queue: 
+                        self.queue_lock.wait()
+                    priority, _, job = heapq.heappop(self.queue)
+                    if priority == job.priority: 
+                        break  # otherwise a stale entry for a job that was bumped up in priority
+                if self.waiting.get(job.key) is job: 
+                    del self.waiting[job.key]
+                self.depth[job.valve] -= 1
+            job.run()
+
+    def queue_stats(self, valve=None): 
+        '''Jobs waiting and superseded-job counts, for one valve or the whole bus.'''
+        with self.queue_lock: 
+            if valve is None: 
+                return {'depth': sum(self.depth.values()), 'coalesced': sum(self.coalesced.values())}
+            return {'depth': self.depth.get(valve, 0), 'coalesced': self.coalesced.get(valve, 0)}
+
+    def get(dev): 
+        '''Get the bus for a serial device, creating it on first use.'''
+        if dev not in SerialBus.buses: 
+            SerialBus.buses[dev] = SerialBus(dev)
+        return SerialBus.buses[dev]
+
+    def add_unit(self, vici): 
+        self.units[vici.id_number] = vici
+
+    def is_open(self): 
+        return self.serial is not None and self.serial.is_open
+
+    def open(self, reopen=False): 
+        '''Open the port, or keep the existing one if another unit is already using it. Raises serial.SerialException.'''
+        if self.is_open() and not reopen and not self.broken: 
+            return
+        if self.serial is not None: 
+            try: 
+                self.serial.close()
+            except Exception: 
+                pass
+        self.buffer.clear()
+        self.serial = serial.Serial(self.dev, timeout=SerialBus.poll_interval)
+        self.broken = False
+
+    def close(self): 
+        if self.serial is not None: 
+            self.serial.close()
+
+    def write(self, data): 
+        return self.serial.write(data)
+
+    def discard_input(self): 
+        '''Drop anything received while no command was waiting for it, eg a reply that came in after its read timed out.
+        Nothing is usually waiting, so this is one in_waiting check.'''
+        waiting = self.serial.in_waiting
+        if waiting: 
+            self.buffer += self.serial.read(waiting)
+        if self.buffer: 
+            log.warning("%s -- dropping unexpected input: %s", self.dev, bytes(self.buffer))
+            self.buffer.clear()
+
+    def read_frame(self, terminator, deadline): 
+        '''Next complete frame (up to and including terminator) from the receive buffer, reading more as it comes in. 
+        Returns as soon as the terminator arrives, or None at deadline (time.monotonic()), leaving a partial frame buffered.'''
+        while True: 
+            end = self.buffer.find(terminator)
+            if end >= 0: 
+                end += len(terminator)
+                frame = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return frame
+            if time.monotonic() >= deadline: 
+                return None
+            self.buffer += self.serial.read(max(1, self.serial.in_waiting))  # blocks for at most poll_interval
+
+    def owner(self, line): 
+        '''id_number of the unit a reply line came from. Unprefixed replies belong to the unit without an id.'''
+        for id_number in self.units: 
+            if id_number is not None and line.startswith(str(id_number)): 
+                return id_number
+        return None
+
+    def read_reply(self, id_number, deadline, terminator=b'\r\n', expect=None): 
+        '''Read until a reply for unit id_number arrives, or b'' at deadline. Late replies from other units on the bus 
+        are dropped, and so are replies to a different command than expect (eg 'CP'), which can only be late ones.'''
+        while True: 
+            raw_reply = self.read_frame(terminator, deadline)
+            if raw_reply is None: 
+                return b''
+            if terminator != b'\r\n': 
+                return raw_reply  # a multi-line reply like /? that has no id prefix
+            line = raw_reply.decode(errors='replace').strip()
+            if len(self.units) > 1: 
+                owner = self.owner(line)
+                if owner != id_number: 
+                    log.warning("%s -- dropping reply meant for unit %s: %s", self.dev, owner, raw_reply)
+                    continue
+            if id_number is not None and line.startswith(str(id_number)): 
+                line = line[len(str(id_number)):]
+            if expect and line.startswith(reply_prefixes) and not line.startswith(expect): 
+                log.warning("%s -- dropping late reply to another command: %s", self.dev, raw_reply)
+                continue
+            return raw_reply
+
+
 class VICI(): 
     '''Controls VICI valves over serial.  Instantiate with name and serial address.'''
     # if failing to connect, should try to reset the device id to None via the command *ID*
     # should try daisy chaining multiple devices and setting their id with ID[nn]
     valves = {}
+    listeners = []  # callables(name, field, value), called when a valve's position or connection status changes
+    state_file = 'vici_state.json'  # confirmed mode/response mode per device, lets a restart skip the full setup
+    saved_state = None  # loaded from state_file on first use
+    state_lock = threading.Lock()
     
-    def __init__(self, name="v1", dev=serial_id_1, id_number=None): 
+    def __init__(self, name="v1", dev=serial_id_1, id_number=None, setup_now=True): 
+        '''setup_now=False leaves the connection to be set up later, eg on the worker via setup_async().'''
         self.name = name
         self.dev = dev 
         self.id_number = id_number 
-        self.timeout = 3 # seconds for serial read timeout
-        self.serial = None
+        self.timeout = 3 # seconds, longest a read waits for a reply, and the timeout until there are round trips to go on
+        self.min_timeout = .3  # seconds, shortest read timeout however fast the device answers
+        self.srtt = None  # smoothed round trip of CP/AM/IFM, seconds
+        self.rttvar = None  # and its mean deviation
+        self.timeout_backoff = 1  # doubles for each read timeout in a row
         self.serial_is_open = False
         self.command_list_header = "Control Command List"
         self.serial_open_tries = 0 
         self.valve_position = None
+        self.pending_read = None  # in-flight CP read, shared by concurrent read_position callers
+        self.initializing = True  # until the first setup() has finished
+        self.actuator_mode = None  # 'AM3' once confirmed
+        self.response_mode = None  # 'IFM0' once confirmed
+        self.breaker = 'closed'  # 'open' while the device is down, 'half_open' while the supervisor is probing it
+        self.consecutive_failures = 0
+        self.failure_threshold = 3  # commands in a row without a reply before the device is treated as down
+        self.min_reconnect_delay = .5  # seconds, reconnect backoff doubles from here...
+        self.max_reconnect_delay = 30  # ...up to here
+        self.reconnect_delay = self.min_reconnect_delay
+        self.positions = 12
+        self.commanded_position = None  # last GO sent
+        self.move_start = None  # monotonic time of the last GO
+        self.move_from = None  # cached position before the last GO
+        self.travel_time = .1  # seconds per port moved, refined from confirmed moves
+        self.move_stats = {'confirmed': 0,            # moves seen arriving at the commanded position
+                           'timed': 0,                # confirmed moves also seen still on the way, so their arrival time is known
+                           'mismatches': 0,           # moves still not there at the deadline
+                           'superseded': 0,           # moves replaced by a newer GO before they were confirmed
+                           'last_commanded': None, 
+                           'last_actual': None, 
+                           'last_time_to_arrival': None, 
+                           'mean_time_to_arrival': None}
 
         self.commands = {'command_list': '/?',     # get command list
                          'current_position': 'CP', # get current position
@@ -36,144 +278,496 @@ class VICI():
                         }
         
         VICI.valves[name] = self
-        self.setup()
+        self.bus = SerialBus.get(dev)
+        self.bus.add_unit(self)
+        if setup_now: 
+            self.setup()
+
+    @property
+    def valve_position(self): 
+        return self._valve_position
+
+    @valve_position.setter
+    def valve_position(self, value): 
+        changed = value != getattr(self, '_valve_position', None)
+        self._valve_position = value
+        self.position_time = time.monotonic() if value is not None else None
+        if changed: 
+            self.notify('valve_position', value)
+
+    @property
+    def serial_is_open(self): 
+        return self._serial_is_open
+
+    @serial_is_open.setter
+    def serial_is_open(self, value): 
+        changed = value != getattr(self, '_serial_is_open', None)
+        self._serial_is_open = value
+        if changed: 
+            self.notify('serial_is_open', value)
+
+    def notify(self, field, value): 
+        '''Tell listeners about a change. Called from whichever thread made the change, usually the device worker, 
+        so listeners must hand off to their own thread/loop.'''
+        for listener in VICI.listeners: 
+            try: 
+                listener(self.name, field, value)
+            except Exception as e: 
+                log.exception("%s -- listener failed", self.name)
         
     def send(self, msg, check_if_open=True): 
+        '''Write a command. If the device is down this fails straight away, the reconnect supervisor brings it back.'''
         if self.serial_is_open or not check_if_open: 
             try: 
                 if self.id_number is None: 
-                    num_bytes_sent = self.serial.write(f'{msg}\r\n'.encode()) 
+                    num_bytes_sent = self.bus.write(f'{msg}\r\n'.encode()) 
                 else: 
-                    num_bytes_sent = self.serial.write(f'{self.id_number}{msg}\r\n'.encode()) 
+                    num_bytes_sent = self.bus.write(f'{self.id_number}{msg}\r\n'.encode()) 
                 return True
-            except: 
-                self.serial_is_open = False
-        elif self.serial_open_tries < 5: 
-            print("Serial connection is not open. Will try to open now.")
-            self.open_serial_connection()
-            self.send(msg)
+            except Exception as e: 
+                self.bus.broken = True
+                if check_if_open: 
+                    self.trip_port(f'write failed: {e}')
+                return False
         else: 
-            print("Giving up. Take a closer look...device is turned off, serial cable unplugged, or usb-serial adapter replaced?")
-            self.serial_open_tries = 0 
             return False
 
-    def send_get(self, msg, check_if_open=True, wait_for_timeout=True, read_until=None): 
-        if self.serial_is_open: 
-            self.serial.flushInput()
-        if self.send(msg, check_if_open): 
-            if wait_for_timeout: 
-                if read_until:
-                    raw_reply = self.serial.read_until(read_until.encode())
-                else:
-                    raw_reply = self.serial.read_until(b'\r\n')
+    def send_get(self, msg, check_if_open=True, read_until=None): 
+        '''Send a command and return its reply as soon as it's in, without the id prefix. Waits up to reply_timeout(). 
+        read_until: end of a multi-line reply, eg for /?. Returns '' if no reply came, False if it couldn't be sent.'''
+        terminator = read_until.encode() if read_until else b'\r\n'
+        try: 
+            if self.serial_is_open or not check_if_open: 
+                self.bus.discard_input()
+            start = time.monotonic()
+            if not self.send(msg, check_if_open): 
+                return False
+            raw_reply = self.bus.read_reply(self.id_number, start + self.reply_timeout(msg), terminator, 
+                                            expect=None if read_until else command_name(msg))
+            if not raw_reply: 
+                serial_timeouts.inc(valve=self.name, command=command_name(msg))
+                journal.record('timeout', self.name, command=command_name(msg))
+                self.timeout_backoff = min(self.timeout_backoff * 2, 16)
+                self.record_failure(f'no reply to {command_name(msg)}')
             else: 
-                time.sleep(.1) # sleep a moment to allow time for response
-                raw_reply = self.serial.read_all()
-            reply = raw_reply.decode().strip()
-            #print(f'Response: {reply}') 
-            return reply 
-        else: return False
+                self.consecutive_failures = 0
+                if not read_until: 
+                    self.record_rtt(time.monotonic() - start)
+        except Exception as e:  # SerialException, or termios/OS errors when the adapter has been unplugged
+            journal.record('error', self.name, command=command_name(msg), error=repr(e))
+            port_error = isinstance(e, (serial.SerialException, OSError))
+            if port_error: 
+                self.bus.broken = True
+            if check_if_open: 
+                if port_error: 
+                    self.trip_port(f'serial error: {e!r}')
+                else: 
+                    self.trip(f'serial error: {e!r}')
+            return False
+        serial_rtt.observe(time.monotonic() - start, valve=self.name, command=command_name(msg))
+        reply = raw_reply.decode().strip()
+        if self.id_number is not None and reply.startswith(str(self.id_number)): 
+            reply = reply[len(str(self.id_number)):]  # daisy chained units prefix replies with their id
+        #print(f'Response: {reply}') 
+        return reply 
+
+    def reply_timeout(self, msg): 
+        '''Seconds to wait for a reply: smoothed round trip plus 4 deviations (as TCP does), at least min_timeout, 
+        doubled for each timeout in a row, at most self.timeout. The long /? reply always gets the full timeout.'''
+        if self.srtt is None or msg == '/?': 
+            return self.timeout
+        return min(self.timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar) * self.timeout_backoff)
+
+    def record_rtt(self, rtt): 
+        '''Fold a reply's round trip into the estimate reply_timeout() uses.'''
+        if self.srtt is None: 
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else: 
+            self.rttvar += (abs(rtt - self.srtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.timeout_backoff = 1
+        reply_timeouts.set(round(self.reply_timeout('CP'), 4), valve=self.name)
     
     def setup(self): 
-        self.open_serial_connection()
-        if self.serial_is_open:
+        '''Open the connection and make sure the VICI is in multiposition, no-response mode. 
+        If the state file says this device was already set up that way, one probe is enough. 
+        If the device isn't there, the reconnect supervisor keeps trying in the background.'''
+        try: 
+            self.open_serial_connection()
+            if self.serial_is_open:
+                self.check_modes()
+            else: 
+                self.trip('not reachable at setup')
+        finally: 
+            if self.initializing: 
+                self.initializing = False
+                self.notify('initializing', False)
+
+    def check_modes(self): 
+        if self.actuator_mode == 'AM3' and self.response_mode == 'IFM0': 
+            return  # already confirmed since we started
+        saved = VICI.get_saved_state(self.state_key())
+        if saved.get('actuator_mode') == 'AM3' and saved.get('response_mode') == 'IFM0': 
+            log.info("%s -- using saved device state, skipping mode checks", self.name)
+            self.actuator_mode, self.response_mode = 'AM3', 'IFM0'
+        else: 
             self.check_actuator_mode()
             self.check_response_mode()
+        self.save_state()
+
+    def record_failure(self, reason): 
+        '''A command got no reply. A few in a row and the device is treated as down.'''
+        if self.breaker != 'closed': 
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold: 
+            self.trip(f'{self.consecutive_failures} failures in a row, last: {reason}')
+
+    def trip(self, reason): 
+        '''Circuit breaker: mark the device down so requests fail in milliseconds instead of waiting on serial 
+        timeouts, and hand reconnecting over to the background supervisor.'''
+        if self.breaker == 'open': 
+            return
+        log.warning("%s -- marking device down (%s), reconnecting in the background", self.name, reason)
+        journal.record('offline', self.name, reason=reason)
+        self.breaker = 'open'
+        self.serial_is_open = False
+        self.schedule_reconnect()
+
+    def trip_port(self, reason): 
+        '''The port itself failed (eg the adapter was unplugged), so every unit daisy chained on it is down too. 
+        Tripping them all means none of them still looks open, and the first reconnect reopens the port.'''
+        for unit in list(self.bus.units.values()): 
+            unit.trip(reason if unit is self else f'{reason} (seen by {self.name})')
+
+    def schedule_reconnect(self): 
+        '''Queue a reconnect attempt on the bus worker after the current backoff delay, then double the delay.'''
+        delay = self.reconnect_delay
+        self.reconnect_delay = min(delay * 2, self.max_reconnect_delay)
+        timer = threading.Timer(delay, self.bus.submit, args=(self.reconnect,), 
+                                kwargs={'priority': SerialBus.BACKGROUND, 'key': (self.name, 'reconnect'), 'valve': self.name})
+        timer.daemon = True
+        timer.start()
+
+    def reconnect(self): 
+        '''One supervisor attempt: probe the device, close the breaker if it answers, otherwise back off and try again.'''
+        self.breaker = 'half_open'
+        self.open_serial_connection()
+        if self.serial_is_open: 
+            self.check_modes()
+            self.breaker = 'closed'
+            self.consecutive_failures = 0
+            self.reconnect_delay = self.min_reconnect_delay
+            log.info("%s -- back online", self.name)
+            journal.record('online', self.name)
+        else: 
+            self.breaker = 'open'
+            self.schedule_reconnect()
+
+    def is_down(self): 
+        '''True while the breaker is open, requests should fail fast.'''
+        return self.breaker != 'closed' and not self.initializing
+
+    def setup_async(self): 
+        '''Queue setup() on this device's worker. Returns a concurrent.futures.Future.'''
+        return self.bus.submit(self.setup, priority=SerialBus.READ, valve=self.name)
+
+    def get_status(self): 
+        return 'initializing' if self.initializing else self.serial_is_open
 
     def open_serial_connection(self): 
-        print(f"------------\n{self.name} -- Opening usb-serial connection")
-        print(f'serial device: {self.dev}')
-        print(f'VICI ID: {self.id_number}')
+        log.info("%s -- opening usb-serial connection, serial device: %s, VICI ID: %s", self.name, self.dev, self.id_number)
         try:
-            self.serial = serial.Serial(self.dev, timeout=self.timeout)
+            # reuse the port if another unit on the bus has it working, otherwise (re)open it
+            others_open = any(u.serial_is_open for u in self.bus.units.values() if u is not self)
+            self.bus.open(reopen=not others_open)
         except: 
-            print("Attempt to open usb-serial connection failed -- USB unplugged?")
+            log.warning("%s -- attempt to open usb-serial connection failed -- USB unplugged?", self.name)
+            reconnects.inc(valve=self.name, result='open_failed')
+            journal.record('connect', self.name, result='open_failed')
             self.serial_is_open = False 
             self.serial_open_tries += 1 
             return
 
-        print('USB-serial opened. Sending test message to check serial...')
-        raw_reply = self.send_get('/?', check_if_open=False, read_until="Displays This List\r\n") 
-        if raw_reply.startswith(self.command_list_header): 
+        log.debug('%s -- USB-serial opened. Sending test message to check serial...', self.name)
+        if self.probe(): 
+            reconnects.inc(valve=self.name, result='ok')
+            journal.record('connect', self.name, result='ok', position=self.valve_position)
             self.serial_is_open = True 
             self.serial_open_tries = 0 
-            print("Serial connection ready")
+            log.info("%s -- serial connection ready", self.name)
         else: 
-            print("Did not get expected response! take a closer look: Serial cable unplugged, VICI is off, etc\n") 
+            reconnects.inc(valve=self.name, result='no_reply')
+            journal.record('connect', self.name, result='no_reply')
+            log.warning("%s -- did not get expected response! take a closer look: Serial cable unplugged, VICI is off, etc", self.name) 
             self.serial_is_open = False
             self.serial_open_tries += 1 
 
+    def probe(self): 
+        '''Check the VICI is there. A single CP is enough and also refreshes the position, which could have changed 
+        while we were away. Falls back to the full command list for units that don't answer CP (eg not in multiposition mode yet).'''
+        reply = self.send_get('CP', check_if_open=False)
+        if reply and reply.startswith('CP') and reply[2:].isdigit(): 
+            self.valve_position = int(reply[2:])
+            return True
+        self.valve_position = None  # don't trust the cache
+        raw_reply = self.send_get('/?', check_if_open=False, read_until="Displays This List\r\n") 
+        return bool(raw_reply) and raw_reply.startswith(self.command_list_header)
+
+    def state_key(self): 
+        return self.dev if self.id_number is None else f'{self.dev}#{self.id_number}'
+
+    def get_saved_state(key): 
+        with VICI.state_lock: 
+            if VICI.saved_state is None: 
+                try: 
+                    with open(VICI.state_file) as f: 
+                        VICI.saved_state = json.load(f)
+                except (OSError, ValueError): 
+                    VICI.saved_state = {}
+            return dict(VICI.saved_state.get(key, {}))
+
+    def save_state(self): 
+        '''Write this device's mode and response mode to the state file (atomically, shared by all devices). 
+        No position: the startup probe reads CP anyway.'''
+        VICI.get_saved_state(self.state_key())  # make sure the file is loaded so other devices' entries are kept
+        with VICI.state_lock: 
+            VICI.saved_state[self.state_key()] = {'actuator_mode': self.actuator_mode, 
+                                                  'response_mode': self.response_mode, 
+                                                  'time': time.time()}
+            try: 
+                with open(VICI.state_file + '.tmp', 'w') as f: 
+                    json.dump(VICI.saved_state, f, indent=1)
+                os.replace(VICI.state_file + '.tmp', VICI.state_file)
+            except OSError as e: 
+                log.warning("%s -- failed to save device state: %s", self.name, e)
+
     def check_actuator_mode(self): 
         '''Check what mode the VICI is in, set to multiposition mode if not there already.'''
         try: 
-            print("Checking VICI actuator mode")
+            log.info("%s -- checking VICI actuator mode", self.name)
             AM = self.send_get('AM')
             if AM == 'AM3': 
-                print("Multiposition mode confirmed")
+                log.info("%s -- multiposition mode confirmed", self.name)
             else: 
-                print(f"Changing AM from {AM} to 3")
-                self.send(b'AM3')
+                log.info("%s -- changing AM from %s to 3", self.name, AM)
+                if not self.send('AM3'): 
+                    return
+            self.actuator_mode = 'AM3'
         except Exception as e: 
-            print("Failed to check actuator mode")
-            print(e)
+            log.exception("%s -- failed to check actuator mode", self.name)
             
     def check_response_mode(self): 
         '''Tell VICI to not send a response for action commands.'''
         try: 
-            print("Checking VICI response mode")
+            log.info("%s -- checking VICI response mode", self.name)
             IFM = self.send_get('IFM')
             if IFM == 'IFM0': 
-                print("Response mode confirmed")
+                log.info("%s -- response mode confirmed", self.name)
             else: 
-                print(f"Changing IFM from {IFM} to 0")
-                self.send(b'IFM0')
+                log.info("%s -- changing IFM from %s to 0", self.name, IFM)
+                if not self.send('IFM0'): 
+                    return
+            self.response_mode = 'IFM0'
         except Exception as e: 
-            print("Failed to check actuator mode")
-            print(e)        
+            log.exception("%s -- failed to check response mode", self.name)
             
     def close(self): 
-        self.serial.close() 
+        if self.serial_is_open: 
+            self.save_state()
+        self.serial_is_open = False
+        if not any(u.serial_is_open for u in self.bus.units.values()): 
+            self.bus.close() 
 
-    def get_valve_position(self): 
+    def read_cp(self): 
+        '''Ask the VICI where it is, without touching the cached position. Returns int or False.'''
         reply = self.send_get('CP')
-        if reply.startswith('CP'):
-            self.valve_position = int(reply.split('CP')[-1])
-            print('current position: ', self.valve_position)
+        if reply and reply.startswith('CP') and reply[2:].isdigit():
+            return int(reply[2:])
+        return False
+
+    def get_valve_position(self): 
+        position = self.read_cp()
+        journal.record('cp', self.name, position=position or None)
+        if position: 
+            self.valve_position = position
+            log.debug('%s -- current position: %s', self.name, self.valve_position)
             return self.valve_position
         else: 
             return False
     
+    def check_position(self, valve_position): 
+        '''valve_position as an int if it's a port on this valve (1 to self.positions), otherwise None.'''
+        try: 
+            valve_position = int(valve_position)
+        except (TypeError, ValueError): 
+            return None
+        return valve_position if 1 <= valve_position <= self.positions else None
+
     def set_valve_position(self, valve_position): 
+        if self.check_position(valve_position) is None: 
+            raise ValueError(f'{self.name}: invalid position {valve_position!r}, expected 1 to {self.positions}')
+        valve_position = int(valve_position)
+        start = time.monotonic()
         if self.send(f'GO{valve_position}'):
-            print(f'requested {valve_position}')
-            #self.get_valve_position()  # dont confirm it got there, replies are too slow 
+            serial_rtt.observe(time.monotonic() - start, valve=self.name, command='GO')
+            log.debug('%s -- requested %s', self.name, valve_position)
+            # no reply to wait for in IFM0, confirm_move() can check it got there 
+            self.move_from, self.move_start = self.valve_position, time.monotonic()
+            self.commanded_position = valve_position
+            journal.record('go', self.name, position=valve_position, previous=self.move_from)
             self.valve_position = valve_position
             return True
         else: 
+            journal.record('go_failed', self.name, position=valve_position)
             return False
 
+    def steps(self, origin, target): 
+        '''Ports the actuator travels from origin to target, the short way round. Half a turn if origin is unknown.'''
+        if not origin: 
+            return self.positions // 2
+        d = abs(target - origin) % self.positions
+        return min(d, self.positions - d)
+
+    async def confirm_move(self, target, timeout=None): 
+        '''Wait until the last GO to target has arrived, polling CP in the background. 
+        The first poll comes halfway through the expected travel (from the measured travel time), then polls back off 
+        from there. Arrival time is only measured when a poll saw the valve still on the way: it's the midpoint of that 
+        poll and the one that saw it arrive.
+        Returns True when it arrives, False if it isn't there by the deadline (timeout seconds from now, default a few 
+        times the travel still expected), None if a newer GO replaced it. Must be called from the IOLoop thread.
+        Waits that start after the move should already be over (eg a sequence's wait_for step) don't count towards 
+        the arrival stats, they can't tell when it got there.'''
+        target = int(target)
+        if self.commanded_position != target or self.move_start is None: 
+            self.move_stats['superseded'] += 1
+            return None
+        start, steps = self.move_start, self.steps(self.move_from, target)
+        expected = steps * self.travel_time
+        now = time.monotonic()
+        late = now - start > expected
+        deadline = now + (timeout if timeout is not None else 2 + 3*max(expected - (now - start), 0))
+        delay = max(first_poll*expected - (now - start), .02)
+        step = max(expected * .25, .02)  # poll interval after the first, grows from here
+        last_miss = None  # when a poll last saw the valve not there yet
+        while True: 
+            await asyncio.sleep(max(0, min(delay, deadline - time.monotonic())))
+            try: 
+                # background polls can wait behind a steady stream of reads, don't let that run past the deadline
+                actual = await asyncio.wait_for(self.run_async(self.read_cp, priority=SerialBus.BACKGROUND), 
+                                                max(deadline - time.monotonic(), .02))
+            except asyncio.TimeoutError: 
+                actual = None
+            now = time.monotonic()
+            if self.commanded_position != target or self.move_start != start: 
+                self.move_stats['superseded'] += 1
+                return None
+            if actual == target: 
+                if late: 
+                    self.record_arrival(target, steps)
+                elif last_miss is not None: 
+                    self.record_arrival(target, steps, elapsed=(last_miss + now) / 2 - start)
+                else: 
+                    self.record_arrival(target, steps, at_most=now - start)
+                self.valve_position = target  # confirmed
+                return True
+            if now >= deadline: 
+                self.record_mismatch(target, actual)
+                if actual: 
+                    self.valve_position = actual
+                return False
+            if actual: 
+                last_miss = now
+            delay, step = step, min(step * 1.5, .5)
+
+    def record_arrival(self, target, steps, elapsed=None, at_most=None): 
+        '''elapsed: measured time to arrival, see confirm_move. Without it, at_most (it was already there at the first 
+        poll) is only an upper bound: it can bring travel_time down, but says nothing about the arrival time.'''
+        journal.record('arrived', self.name, position=target, time_to_arrival=elapsed)
+        stats = self.move_stats
+        stats['confirmed'] += 1
+        stats['last_commanded'] = stats['last_actual'] = target
+        stats['last_time_to_arrival'] = elapsed
+        if elapsed is not None: 
+            stats['timed'] += 1
+            mean = stats['mean_time_to_arrival']
+            stats['mean_time_to_arrival'] = elapsed if mean is None else mean + (elapsed - mean) / stats['timed']
+            if steps: 
+                self.travel_time = .8*self.travel_time + .2*(elapsed / steps)
+        elif at_most is not None and steps: 
+            self.travel_time = min(self.travel_time, .8*self.travel_time + .2*(at_most / steps))
+
+    def record_mismatch(self, target, actual): 
+        log.warning("%s -- commanded %s but valve is at %s", self.name, target, actual)
+        journal.record('mismatch', self.name, commanded=target, position=actual or None)
+        self.move_stats['mismatches'] += 1
+        self.move_stats['last_commanded'] = target
+        self.move_stats['last_actual'] = actual
+
+    def get_move_stats(self): 
+        return dict(self.move_stats, travel_time=self.travel_time)
+
+    def position_age(self): 
+        '''Seconds since the cached valve_position was last set by a GO or confirmed by a CP, None if unknown.'''
+        if self.position_time is None: 
+            return None
+        return time.monotonic() - self.position_time
+
+    async def read_position(self, max_age=None): 
+        '''Get the valve position, answering from the cache if it is at most max_age seconds old. 
+        Otherwise read CP from the valve. Concurrent reads share the same in-flight CP.
+        Must be called from the IOLoop thread.'''
+        age = self.position_age()
+        if max_age is not None and age is not None and age <= max_age: 
+            return self.valve_position
+        if self.pending_read is None: 
+            self.pending_read = asyncio.ensure_future(self.run_async(self.get_valve_position))
+            self.pending_read.add_done_callback(self.clear_pending_read)
+        return await asyncio.shield(self.pending_read)
+
+    def clear_pending_read(self, future): 
+        if self.pending_read is future: 
+            self.pending_read = None
+
+    def run_async(self, func, *args, priority=None, key=None): 
+        '''Run a blocking call (eg self.get_valve_position) on this device's bus worker thread. 
+        Returns an awaitable, so the server's IOLoop keeps serving other valves while this one waits on serial. 
+        priority is one of SerialBus.MOVE/READ/BACKGROUND (default READ). A key lets a newer call for this valve 
+        replace one with the same key that is still waiting, see SerialBus.'''
+        key = (self.name, key) if key is not None else None
+        return asyncio.wrap_future(self.bus.submit(func, *args, priority=priority, key=key, valve=self.name))
+
+    def move_async(self, valve_position): 
+        '''Interactive move: jumps ahead of reads, and replaces any GO for this valve that hasn't gone out yet.'''
+        return self.run_async(self.set_valve_position, valve_position, priority=SerialBus.MOVE, key='GO')
+
+    def queue_stats(self): 
+        return self.bus.queue_stats(self.name)
+
     def get_all_connections_open(): 
         return all([v.serial_is_open for v in VICI.valves.values()])
     
     def check_all_connections_open(): 
         if VICI.get_all_connections_open(): 
-            print('All connections good!')
+            log.info('All connections good!')
         else: 
             for v in VICI.valves.values(): 
                 if not v.serial_is_open: 
-                    print(f'{v.name} is not open') 
+                    log.warning('%s is not open', v.name) 
 
 
-def import_valve_config(): 
+def import_valve_config(cfg_file='VICI_config.csv'): 
     '''Will attempt to import a csv config file formatted as: 
             device_name_1, device_serial_addr_1
             device_name_2, device_serial_addr_2, 
             ...
+        Daisy chained VICIs share a serial address and add their ID as a third column: 
+            device_name_3, device_serial_addr_3, 1
+            device_name_4, device_serial_addr_3, 2
 
-        The parser is pretty raw...
+        The parser is pretty raw... returns {name: (serial_addr, id_number)}
     '''
-    cfg_file = 'VICI_config.csv' 
-    if cfg_file in os.listdir(): 
+    if os.path.isfile(cfg_file): 
         try: 
             cfg_file_raw = open(cfg_file).read().strip()
             device_lines = cfg_file_raw.split('\n')
@@ -181,31 +775,41 @@ def import_valve_config():
             for line in device_lines: 
                 if not line.startswith('#'):
                     if line.count(',') == 1: 
+                        devices_2d.append(line.split(',') + [''])
+                    elif line.count(',') == 2: 
                         devices_2d.append(line.split(','))
-            devices = {d[0]:d[1] for d in devices_2d}
+            devices = {d[0].strip():(d[1].strip(), d[2].strip() or None) for d in devices_2d}
             return devices
         except: 
-            print("Failed to import config file")
+            log.exception("Failed to import config file %s", cfg_file)
             return 0 
     else: 
         # no config file found
         return 0 
 
 
-def setup_valves(): 
-    devices = import_valve_config()
+def setup_valves(cfg_file='VICI_config.csv', wait=True): 
+    '''Create the VICIs and set them up concurrently, one worker per serial port. 
+    With wait=False this returns right away and valves report 'initializing' until their setup finishes.'''
+    devices = import_valve_config(cfg_file)
     if not devices: 
         # no devices imported, using defaults
-        v1 = VICI(name='v1', dev=serial_id_1)
-        v2 = VICI(name='v2', dev=serial_id_2)
-        v3 = VICI(name='v3', dev=serial_id_3)
-        v4 = VICI(name='v4', dev=serial_id_4)
+        devices = {'v1': (serial_id_1, None), 'v2': (serial_id_2, None), 'v3': (serial_id_3, None), 'v4': (serial_id_4, None)}
+
+    futures = []
+    for name, (serial_addr, id_number) in devices.items(): 
+        try: 
+            futures.append(VICI(name=name, dev=serial_addr, id_number=id_number, setup_now=False).setup_async())
+        except: 
+            log.exception("Failed to setup %s, %s", name, serial_addr)
+
+    def report(): 
+        concurrent.futures.wait(futures)
+        VICI.check_all_connections_open()
+
+    if wait: 
+        report()
     else: 
-        for name, serial_addr in devices.items(): 
-            try: 
-                VICI(name=name, dev=serial_addr)
-            except: 
-                print(f"Failed to setup {name}, {serial_addr}")
-    print('\n\n\n----------------')
-    VICI.check_all_connections_open()
+        threading.Thread(target=report, name='vici-setup-report', daemon=True).start()
+    return futures
 
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+# Simulated VICI valves on pseudo-terminals, so the driver and server can be run and benchmarked without hardware.
+#
+# Each simulated bus is a pty that looks like a usb-serial adapter, with one or more VICI units daisy chained on it.
+# A stable symlink (eg /tmp/vici-sim/v1) points at the pty, the same way /dev/serial/by-id/... points at a real adapter,
+# so it can go straight into VICI_config.csv.
+#
+# Speaks the subset of the protocol valve_driver uses:
+#   /?        command list
+#   CP        current position            -> CP03
+#   GO<n>     go to position n            (no reply in IFM0, CP reply on arrival in IFM1)
+#   AM, AM3   actuator mode               -> AM3
+#   IFM, IFM0 response mode               -> IFM0
+#   ID, ID<x> device id                   -> ID1
+# Commands may be prefixed with a unit's id (eg '1CP') to address one unit on a shared bus, replies are prefixed the same way.
+#
+# Run standalone:
+#   python vici_simulator.py v1 v2 v3 v4 --config sim_config.csv
+#   python server.py sim_config.csv
+# Daisy chained units are written name@bus:id, eg 'a@chain:1 b@chain:2' puts units 1 and 2 on one simulated port.
+
+import os
+import pty
+import time
+import tty
+import random
+import select
+import argparse
+import threading
+
+command_list = (
+    "Control Command List\r\n"
+    "AM     Actuator Mode\r\n"
+    "CP     Current Position\r\n"
+    "GOnn   Go To Position nn\r\n"
+    "ID     Device ID\r\n"
+    "IFM    Response Mode\r\n"
+    "/?     Displays This List\r\n"
+)
+
+
+class SimulatedVICI():
+    '''One multiposition VICI unit. Position changes take travel_time seconds per port moved.'''
+
+    def __init__(self, id_number=None, positions=12, position=1, travel_time=.05):
+        self.id_number = None if id_number is None else str(id_number)
+        self.positions = positions
+        self.travel_time = travel_time
+        self.actuator_mode = 1  # comes up out of multiposition mode like a fresh unit, driver should set AM3
+        self.response_mode = 1
+        self.start_position = position
+        self.target = position
+        self.arrival = 0
+
+    @property
+    def position(self):
+        '''Reports the old position until the actuator has finished travelling.'''
+        return self.target if time.monotonic() >= self.arrival else self.start_position
+
+    def go(self, target):
+        self.start_position = self.position
+        self.target = target
+        steps = abs(target - self.start_position)
+        steps = min(steps, self.positions - steps)  # actuator takes the short way round
+        self.arrival = time.monotonic() + steps * self.travel_time
+
+    def handle(self, cmd):
+        '''Run one command (id prefix already removed). Returns (delay, reply) where reply is sent after delay seconds, or None.'''
+        if cmd == '/?':
+            return 0, command_list
+        if cmd == 'CP':
+            return 0, f'CP{self.position:02d}'
+        if cmd.startswith('GO') and cmd[2:].isdigit() and 1 <= int(cmd[2:]) <= self.positions:
+            self.go(int(cmd[2:]))
+            if self.response_mode:
+                return self.arrival - time.monotonic(), f'CP{self.target:02d}'
+            return 0, None
+        if cmd == 'AM':
+            return 0, f'AM{self.actuator_mode}'
+        if cmd.startswith('AM') and cmd[2:].isdigit():
+            self.actuator_mode = int(cmd[2:])
+            return 0, None
+        if cmd == 'IFM':
+            return 0, f'IFM{self.response_mode}'
+        if cmd.startswith('IFM') and cmd[3:].isdigit():
+            self.response_mode = int(cmd[3:])
+            return 0, None
+        if cmd == 'ID':
+            return 0, f'ID{self.id_number or ""}'
+        if cmd.startswith('ID') and len(cmd) == 3:
+            self.id_number = cmd[2]
+            return 0, None
+        return 0, 'Bad command'
+
+
+class SimulatedBus():
+    '''A pty standing in for a usb-serial adapter, with one or more SimulatedVICI units on it.
+
+    Fault injection:
+        latency          seconds before every reply
+        command_latency  per-command override, eg {'CP': .05, '/?': .5}
+        drop_rate        probability that each reply byte is lost
+        disconnect()     pull the usb cable, reconnect() plugs it back in on a new pty behind the same link
+    '''
+
+    def __init__(self, link, units=None, latency=.005, command_latency=None, drop_rate=0, seed=None):
+        self.link = link
+        self.units = units if units is not None else [SimulatedVICI()]
+        self.latency = latency
+        self.command_latency = command_latency or {}
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.master = None
+        self.slave = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)  # no echo or newline translation, like a real serial line
+        os.makedirs(os.path.dirname(self.link) or '.', exist_ok=True)
+        if os.path.lexists(self.link):
+            os.remove(self.link)
+        os.symlink(os.ttyname(self.slave), self.link)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=f'vici-sim-{os.path.basename(self.link)}', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+        if os.path.lexists(self.link):
+            os.remove(self.link)
+
+    def disconnect(self):
+        self.stop()
+
+    def reconnect(self):
+        self.start()
+
+    def find_unit(self, line):
+        '''Split an id prefix off a command. Unprefixed commands go to the unit with no id (or the first unit).'''
+        for unit in self.units:
+            if unit.id_number is not None and line.startswith(unit.id_number) and len(line) > len(unit.id_number):
+                return unit, line[len(unit.id_number):]
+        for unit in self.units:
+            if unit.id_number is None:
+                return unit, line
+        return self.units[0], line
+
+    def run(self):
+        buffer = b''
+        pending = []  # (send_at, bytes) for replies that are waiting on latency or actuator travel
+        while self.running:
+            timeout = max(0, min(t for t, _ in pending) - time.monotonic()) if pending else .05
+            ready, _, _ = select.select([self.master], [], [], min(timeout, .05))
+            if ready:
+                try:
+                    buffer += os.read(self.master, 1024)
+                except OSError:
+                    pass  # nothing has the slave open right now
+                *lines, buffer = buffer.replace(b'\n', b'').split(b'\r')
+                for line in lines:
+                    self.handle(line.decode(errors='replace').strip(), pending)
+
+            now = time.monotonic()
+            for item in sorted(p for p in pending if p[0] <= now):
+                pending.remove(item)
+                self.write(item[1])
+
+    def handle(self, line, pending):
+        if not line:
+            return
+        unit, cmd = self.find_unit(line)
+        delay, reply = unit.handle(cmd)
+        if reply is None:
+            return
+        if cmd != '/?' and unit.id_number is not None:
+            reply = unit.id_number + reply
+        latency = self.command_latency.get(cmd[:3] if cmd.startswith('IFM') else cmd[:2], self.latency)
+        pending.append((time.monotonic() + latency + max(delay, 0), f'{reply}\r\n'.encode()))
+
+    def write(self, data):
+        if self.drop_rate:
+            data = bytes(b for b in data if self.random.random() >= self.drop_rate)
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+
+def parse_names(names):
+    '''['v1', 'a@chain:1', 'b@chain:2'] -> {bus name: [(valve name, id or None), ...]}'''
+    buses = {}
+    for name in names:
+        valve, _, where = name.partition('@')
+        bus, _, id_number = where.partition(':')
+        buses.setdefault(bus or valve, []).append((valve, id_number or None))
+    return buses
+
+
+def write_config(buses, layout, cfg_file):
+    '''Write a VICI_config.csv style file pointing at the simulated devices.'''
+    with open(cfg_file, 'w') as f:
+        f.write('# simulated devices, written by vici_simulator.py\n')
+        for bus, units in zip(buses, layout.values()):
+            for valve, id_number in units:
+                f.write(f'{valve},{bus.link},{id_number}\n' if id_number else f'{valve},{bus.link}\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated VICI valves on pseudo-terminals')
+    parser.add_argument('names', nargs='*', default=['v1', 'v2', 'v3', 'v4'], help='one simulated device per name, or name@bus:id for daisy chains')
+    parser.add_argument('--dir', default='/tmp/vici-sim', help='where to put the device symlinks')
+    parser.add_argument('--config', default=None, help='write a VICI_config.csv style file for the server')
+    parser.add_argument('--latency', type=float, default=.005, help='seconds before each reply')
+    parser.add_argument('--travel', type=float, default=.05, help='actuator seconds per port moved')
+    parser.add_argument('--drop', type=float, default=0, help='probability of dropping each reply byte')
+    parser.add_argument('--flap', action='append', default=[], help='name of a device (or bus) to unplug/replug periodically')
+    parser.add_argument('--flap-period', type=float, default=10, help='seconds between unplug/replug for --flap devices')
+    args = parser.parse_args()
+
+    layout = parse_names(args.names)
+    buses = [SimulatedBus(os.path.join(args.dir, name),
+                          units=[SimulatedVICI(id_number=id_number, travel_time=args.travel) for _, id_number in units],
+                          latency=args.latency,
+                          drop_rate=args.drop).start()
+             for name, units in layout.items()]
+    for name, bus in zip(layout, buses):
+        print(f'{name}: {bus.link} -> {os.ttyname(bus.slave)}')
+    if args.config:
+        write_config(buses, layout, args.config)
+        print(f'wrote {args.config}')
+
+    try:
+        while True:
+            time.sleep(args.flap_period)
+            for (name, units), bus in zip(layout.items(), buses):
+                if name in args.flap or any(valve in args.flap for valve, _ in units):
+                    if bus.running:
+                        print(f'{name}: unplugged')
+                        bus.disconnect()
+                    else:
+                        print(f'{name}: plugged back in')
+                        bus.reconnect()
+    except KeyboardInterrupt:
+        for bus in buses:
+            if bus.running:
+                bus.stop()